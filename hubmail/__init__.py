@@ -1 +1,24 @@
-from hubmail.hubmail import Hubmail
+from importlib import import_module
+
+from typing import Any, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from hubmail.hubmail import Hubmail, export
+    from hubmail.config import Config
+    from hubmail.message import Message
+
+# The library API, and the module defining each name
+_API = {
+    "Hubmail": "hubmail.hubmail",
+    "export": "hubmail.hubmail",
+    "Config": "hubmail.config",
+    "Message": "hubmail.message",
+}
+
+def __getattr__(name: str) -> Any:
+    # The API is imported on first use, so that the command line can be
+    # parsed (and -h answered) without importing aiohttp and the rest of what
+    # an export needs
+    if name in _API:
+        return getattr(import_module(_API[name]), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
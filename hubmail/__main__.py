@@ -1,10 +1,10 @@
-from hubmail import Hubmail
-
-from argparse import ArgumentParser
+from argparse import ArgumentParser, ArgumentTypeError
+from hubmail.timeline import TIMELINE_ITEM_TYPES
 import textwrap
-import asyncio
 import os
 
+from typing import List, Optional, Tuple
+
 def get_parser() -> ArgumentParser:
     parser = ArgumentParser(
         prog="hubmail",
@@ -15,58 +15,234 @@ def get_parser() -> ArgumentParser:
     subparsers = parser.add_subparsers(
         title="subcommands", dest="subcommand", required=True)
 
-    parent_parser = ArgumentParser(add_help=False)
-    parent_parser.add_argument(
-        "user", metavar="USER",
-        help="The username of the owner of the repository")
-    parent_parser.add_argument(
-        "repo", metavar="REPO",
-        help="The name of the repository")
-    parent_parser.add_argument(
+    options_parser = ArgumentParser(add_help=False)
+    options_parser.add_argument(
         "-c", "--comments", metavar="N", type=int, nargs="?", default=0,
         const=None,
         help=textwrap.dedent("""\
-            Include the first %(metavar)s comments is %(metavar)s is positive,
-            otherwise the latest %(metavar)s comments
-            [default: all comments if -c provided, otherwise no comments]
+            Include the first %(metavar)s items of the timeline of each
+            thread (see --timeline) if %(metavar)s is positive, otherwise the
+            latest %(metavar)s items
+            [default: all of them if -c provided, otherwise none]
             """))
-    parent_parser.add_argument(
+    options_parser.add_argument(
+        "--timeline", metavar="KINDS", type=parse_timeline,
+        default=["comments"],
+        help=textwrap.dedent(f"""\
+            Export the given kinds of timeline items with -c, as a
+            comma-separated list of {", ".join(TIMELINE_ITEM_TYPES)}
+            (reviews include their comments on lines of the pull request)
+            [default: comments]
+            """))
+    options_parser.add_argument(
         "-w", "--wrap", metavar="COLS", type=int, nargs="?", const=72,
         help=textwrap.dedent("""\
             Wrap each line of text to %(metavar)s columns
             [default: 72 if -w provided]
             """))
-    parent_parser.add_argument(
+    options_parser.add_argument(
         "--extended-subject", action="store_true",
         help=textwrap.dedent("""\
             Include the repository name and thread number in each email's
             subject line (like GitHub notification emails)
             """))
-    parent_parser.add_argument(
+    options_parser.add_argument(
+        "-o", "--output", metavar="FILE",
+        help=textwrap.dedent("""\
+            Append messages to %(metavar)s as soon as each one is formatted
+            [default: standard output]
+            """))
+    options_parser.add_argument(
+        "--output-format", choices=["mbox", "maildir", "sharded"],
+        default="mbox",
+        help=textwrap.dedent("""\
+            Write a single mbox file, a Maildir with one file per message, or
+            a directory of mbox files with one file per --shard-size threads;
+            for maildir and sharded, -o names the directory (a Maildir keeps
+            the first version exported of each message, even if it is
+            edited later) [default: %(default)s]
+            """))
+    options_parser.add_argument(
+        "--shard-size", metavar="N", type=int, default=1,
+        help=textwrap.dedent("""\
+            Put up to %(metavar)s consecutively numbered threads in each mbox
+            file of sharded output [default: %(default)s]
+            """))
+    options_parser.add_argument(
+        "--page-size", metavar="N", type=int,
+        help=textwrap.dedent("""\
+            Request %(metavar)s threads or comments per page of results
+            [default: start at 20 and adapt between 5 and 100 to how quickly
+            GitHub responds]
+            """))
+    options_parser.add_argument(
+        "--render-jobs", metavar="N", type=int, default=0,
+        help=textwrap.dedent("""\
+            Render messages (text wrapping, Markdown parsing, and MIME
+            encoding) in %(metavar)s worker processes while threads are
+            fetched, or in the main process if %(metavar)s is 0 [default:
+            %(default)s]
+            """))
+    options_parser.add_argument(
+        "--queue-size", metavar="N", type=int, default=64,
+        help=textwrap.dedent("""\
+            Buffer up to %(metavar)s messages of each thread or repository
+            formatted ahead of the one being written; formatting waits once
+            the buffer is full [default: %(default)s]
+            """))
+    options_parser.add_argument(
+        "--max-image-size", metavar="MB", type=int, default=10,
+        help=textwrap.dedent("""\
+            Do not attach images larger than %(metavar)s megabytes
+            [default: %(default)s]
+            """))
+    options_parser.add_argument(
+        "--max-attachments-size", metavar="MB", type=int, default=25,
+        help=textwrap.dedent("""\
+            Stop attaching images to an email once they add up to
+            %(metavar)s megabytes [default: %(default)s]
+            """))
+    options_parser.add_argument(
+        "--image-cache-size", metavar="MB", type=int, default=64,
+        help=textwrap.dedent("""\
+            Keep up to %(metavar)s megabytes of downloaded images in memory
+            for reuse by other emails linking them [default: %(default)s]
+            """))
+    options_parser.add_argument(
+        "--cache", metavar="FILE", nargs="?", const=default_cache_file(),
+        help=textwrap.dedent("""\
+            Cache API responses, patches, and images in the SQLite database
+            %(metavar)s, revalidating patches and images with their ETags
+            [default: $XDG_CACHE_HOME/hubmail/cache.sqlite if --cache
+            provided]
+            """))
+    options_parser.add_argument(
+        "--cache-size", metavar="MB", type=int, default=512,
+        help=textwrap.dedent("""\
+            Evict the least recently used entries once the cache is larger
+            than %(metavar)s megabytes [default: %(default)s]
+            """))
+    options_parser.add_argument(
+        "--cache-max-age", metavar="SECONDS", type=int, default=3600,
+        help=textwrap.dedent("""\
+            Reuse cached GraphQL results for at most %(metavar)s seconds
+            [default: %(default)s]
+            """))
+    options_parser.add_argument(
+        "--connections", metavar="N", type=int, default=20,
+        help=textwrap.dedent("""\
+            Keep up to %(metavar)s connections open to each host (the API,
+            and hosts of patches and images) [default: %(default)s]
+            """))
+    options_parser.add_argument(
+        "--timeout", metavar="SECONDS", type=float, default=60,
+        help=textwrap.dedent("""\
+            Give up on connecting, or on waiting for more of a response,
+            after %(metavar)s seconds [default: %(default)s]
+            """))
+    options_parser.add_argument(
+        "--retries", metavar="N", type=int, default=5,
+        help=textwrap.dedent("""\
+            Retry each request up to %(metavar)s times after connection
+            errors, timeouts, server errors, and secondary rate limits,
+            waiting exponentially longer between retries
+            [default: %(default)s]
+            """))
+    options_parser.add_argument(
+        "--stats", action="store_true",
+        help=textwrap.dedent("""\
+            Print a summary of the time spent in each stage of the export
+            (GraphQL queries, downloads, rendering, writing), data
+            transferred, GraphQL rate limit cost, and cache hit rates to
+            standard error when done
+            """))
+    options_parser.add_argument(
+        "--trace", metavar="FILE",
+        help=textwrap.dedent("""\
+            Write each query, download, rendering, and write to %(metavar)s as
+            a line of JSON with its stage, start time, duration, and details
+            such as bytes transferred
+            """))
+    options_parser.add_argument(
+        "--api-url", metavar="URL", default="https://api.github.com/graphql",
+        help=textwrap.dedent("""\
+            The GraphQL endpoint to query, e.g. for GitHub Enterprise Server
+            [default: %(default)s]
+            """))
+    options_parser.add_argument(
         "--html", action="store_true",
         help=textwrap.dedent("""\
             Generate multipart emails with a HTML part (rendered Markdown
             from GitHub)
             """))
 
+    parent_parser = ArgumentParser(add_help=False, parents=[options_parser])
+    parent_parser.add_argument(
+        "user", metavar="USER",
+        help="The username of the owner of the repository")
+    parent_parser.add_argument(
+        "repo", metavar="REPO",
+        help="The name of the repository")
+
+    jobs_parser = ArgumentParser(add_help=False)
+    jobs_parser.add_argument(
+        "-j", "--jobs", metavar="N", type=int, default=4,
+        help=textwrap.dedent("""\
+            Format up to %(metavar)s threads concurrently; output is still
+            in thread order [default: %(default)s]
+            """))
+
     issue_parser = subparsers.add_parser(
-        "issue", parents=[parent_parser],
-        usage="%(prog)s [options] USER REPO NUMBER",
-        description="Export one issue in mbox format")
+        "issue", parents=[parent_parser, jobs_parser],
+        usage="%(prog)s [options] USER REPO NUMBERS",
+        description="Export issues by number in mbox format")
     pull_parser = subparsers.add_parser(
-        "pull", parents=[parent_parser],
-        usage="%(prog)s [options] USER REPO NUMBER",
-        description="Export one pull request in mbox format")
+        "pull", parents=[parent_parser, jobs_parser],
+        usage="%(prog)s [options] USER REPO NUMBERS",
+        description="Export pull requests by number in mbox format")
 
     issue_parser.add_argument(
-        "number", metavar="NUMBER", type=int,
-        help="The number of the issue")
+        "numbers", metavar="NUMBERS", type=parse_numbers,
+        help=textwrap.dedent("""\
+            The numbers of the issues: a comma-separated list of numbers and
+            ranges, e.g. 1-500,812,900- (a range without an end goes up to
+            the latest issue; numbers of pull requests in ranges are skipped)
+            """))
     pull_parser.add_argument(
-        "number", metavar="NUMBER", type=int,
-        help="The number of the pull request")
+        "numbers", metavar="NUMBERS", type=parse_numbers,
+        help=textwrap.dedent("""\
+            The numbers of the pull requests: a comma-separated list of
+            numbers and ranges, e.g. 1-500,812,900- (a range without an end
+            goes up to the latest pull request; numbers of issues in ranges
+            are skipped)
+            """))
+
+    threads_parser = ArgumentParser(add_help=False, parents=[jobs_parser])
+    threads_parser.add_argument(
+        "--since", metavar="TIMESTAMP",
+        help=textwrap.dedent("""\
+            Only export threads updated after %(metavar)s (ISO 8601, UTC if
+            no time zone is given), and only the messages in them that were
+            created, edited or (for commits) committed after then; -t is
+            ignored
+            """))
+    threads_parser.add_argument(
+        "--state", metavar="FILE",
+        help=textwrap.dedent("""\
+            Export only what was updated since the last successful run with
+            the same %(metavar)s (unless --since is provided), and record the
+            time of the latest update exported in %(metavar)s
+            """))
 
     repo_parent_parser = ArgumentParser(
-        add_help=False, parents=[parent_parser])
+        add_help=False, parents=[parent_parser, threads_parser])
+    repo_parent_parser.add_argument(
+        "--resume", action="store_true",
+        help=textwrap.dedent("""\
+            Continue an interrupted export to the file given by -o from the
+            checkpoint saved next to it, without fetching or writing again
+            the threads already written
+            """))
 
     issues_parser = subparsers.add_parser(
         "issues", parents=[repo_parent_parser],
@@ -90,10 +266,89 @@ def get_parser() -> ArgumentParser:
             otherwise the latest %(metavar)s threads [default: all threads]
             """))
 
+    repos_parser = subparsers.add_parser(
+        "repos", parents=[options_parser, threads_parser],
+        usage="%(prog)s [options] [USER/REPO ...]",
+        description=textwrap.dedent("""\
+            Export issues and pull requests from many repositories in mbox
+            format, in one session (messages from different repositories
+            may be interleaved)
+            """))
+    repos_parser.add_argument(
+        "repos", metavar="USER/REPO", nargs="*", type=parse_repo,
+        help="A repository to export")
+    repos_parser.add_argument(
+        "--org", metavar="ORG", action="append", default=[],
+        help=textwrap.dedent("""\
+            Export all repositories of the organization %(metavar)s (may be
+            repeated)
+            """))
+    repos_parser.add_argument(
+        "--only", choices=["issues", "pulls"],
+        help="Export only issues or only pull requests")
+    repos_parser.add_argument(
+        "--repo-jobs", metavar="N", type=int, default=4,
+        help=textwrap.dedent("""\
+            Export up to %(metavar)s repositories concurrently
+            [default: %(default)s]
+            """))
+    repos_parser.add_argument(
+        "-t", "--threads", metavar="N", type=int,
+        help=textwrap.dedent("""\
+            Include the first %(metavar)s threads of each repository if
+            %(metavar)s is positive, otherwise the latest %(metavar)s threads
+            [default: all threads]
+            """))
+
     return parser
 
+def default_cache_file() -> str:
+    # Not in hubmail.cache, which imports sqlite3 and the rest of what the
+    # cache needs
+    cache_home = (os.getenv("XDG_CACHE_HOME")
+                  or os.path.join(os.path.expanduser("~"), ".cache"))
+    return os.path.join(cache_home, "hubmail", "cache.sqlite")
+
+def parse_numbers(text: str) -> List[Tuple[int, Optional[int]]]:
+    """Parses a list of thread numbers and ranges like "1-500,812,900-" into
+    inclusive ranges, with None as the end of a range without one"""
+    ranges: List[Tuple[int, Optional[int]]] = []
+    for part in text.split(","):
+        start, dash, end = part.strip().partition("-")
+        try:
+            first = int(start)
+            last = (None if dash and not end.strip()
+                    else int(end) if dash else first)
+        except ValueError:
+            raise ArgumentTypeError(f"invalid number or range: {part!r}")
+        if first < 1 or last is not None and last < first:
+            raise ArgumentTypeError(f"invalid number or range: {part!r}")
+        ranges.append((first, last))
+    return ranges
+
+def parse_repo(text: str) -> str:
+    """Checks that a repository is given as USER/REPO"""
+    user, _, repo = text.partition("/")
+    if not user or not repo or "/" in repo:
+        raise ArgumentTypeError(f"invalid repository: {text!r}")
+    return text
+
+def parse_timeline(text: str) -> List[str]:
+    """Parses a comma-separated list of kinds of timeline items"""
+    kinds = [kind.strip() for kind in text.split(",") if kind.strip()]
+    for kind in kinds:
+        if kind not in TIMELINE_ITEM_TYPES:
+            raise ArgumentTypeError(f"invalid kind of timeline item: {kind!r}")
+    return kinds
+
 def main() -> None:
-    asyncio.run(Hubmail(get_parser().parse_args()).main())
+    arguments = get_parser().parse_args()
+    # Only imported once the arguments are known to be valid, as importing
+    # aiohttp and the rest of what an export needs takes most of the startup
+    # time
+    import asyncio
+    from hubmail.hubmail import Hubmail
+    asyncio.run(Hubmail(arguments).main())
 
 if __name__ == "__main__":
     main()
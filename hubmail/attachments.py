@@ -0,0 +1,109 @@
+# This file is part of hubmail.
+# SPDX-License-Identifier: LGPL-2.1-or-later
+
+import sys
+import asyncio
+import mimetypes
+import posixpath
+from collections import OrderedDict
+from urllib.parse import urlparse
+
+from typing import (Callable, Awaitable, Optional, List, Dict, NamedTuple,
+                    Iterable)
+from hubmail.stats import Stats
+
+class TooLargeError(Exception):
+    """Raised when a download is larger than the allowed size"""
+
+class Attachment(NamedTuple):
+    url: str
+    data: bytes
+    maintype: str
+    subtype: str
+    filename: str
+
+    @classmethod
+    def from_url(cls, url: str, data: bytes) -> "Attachment":
+        maintype, subtype = (mimetypes.guess_type(url)[0] or
+                             "application/octet-stream").split("/")
+        filename = posixpath.basename(urlparse(url).path)
+        return cls(url, data, maintype, subtype, filename)
+
+class AttachmentFetcher:
+    """Downloads the images linked from a message concurrently, sharing
+    downloads of the same URL across the whole run
+
+    Downloaded images are kept in a least recently used cache of at most
+    cache_size bytes. Images larger than max_image_size bytes are skipped, as
+    are images that would make the attachments of one message larger than
+    max_message_size bytes.
+    """
+    def __init__(self, fetch: Callable[[str, Optional[int]], Awaitable[bytes]],
+                 cache_size: int, max_image_size: int,
+                 max_message_size: int, stats: Optional[Stats] = None) -> None:
+        self.fetch = fetch
+        self.stats = stats
+        self.cache_size = cache_size
+        self.max_image_size = max_image_size
+        self.max_message_size = max_message_size
+        self.cache: "OrderedDict[str, bytes]" = OrderedDict()
+        self.cached_bytes = 0
+        # Downloads in progress, so that concurrent messages linking the same
+        # image share one request
+        self.pending: Dict[str, "asyncio.Future[bytes]"] = {}
+
+    async def _get(self, url: str) -> bytes:
+        if self.stats:
+            self.stats.cache("image (in memory)", url in self.cache)
+        if url in self.cache:
+            self.cache.move_to_end(url)
+            return self.cache[url]
+        if url not in self.pending:
+            self.pending[url] = asyncio.ensure_future(
+                self.fetch(url, self.max_image_size))
+        try:
+            data = await asyncio.shield(self.pending[url])
+        finally:
+            if url in self.pending and self.pending[url].done():
+                del self.pending[url]
+        self._store(url, data)
+        return data
+
+    def cancel(self) -> None:
+        """Cancels the downloads in progress, once no message needs them"""
+        for future in self.pending.values():
+            future.cancel()
+        self.pending.clear()
+
+    def _store(self, url: str, data: bytes) -> None:
+        if url in self.cache or len(data) > self.cache_size:
+            return
+        self.cache[url] = data
+        self.cached_bytes += len(data)
+        while self.cached_bytes > self.cache_size:
+            _, evicted = self.cache.popitem(last=False)
+            self.cached_bytes -= len(evicted)
+
+    async def fetch_all(self, urls: Iterable[str]) -> List[Attachment]:
+        """Downloads images for one message, skipping (with a warning) those
+        that fail or exceed the size limits"""
+        urls = list(OrderedDict.fromkeys(urls))
+        results = await asyncio.gather(*(self._get(url) for url in urls),
+                                       return_exceptions=True)
+        attachments = []
+        total = 0
+        for url, result in zip(urls, results):
+            if isinstance(result, BaseException):
+                reason = ("larger than the maximum image size"
+                          if isinstance(result, TooLargeError)
+                          else repr(result))
+                print(f"hubmail: skipping image {url}: {reason}",
+                      file=sys.stderr)
+                continue
+            if total + len(result) > self.max_message_size:
+                print(f"hubmail: skipping image {url}: attachments would be "
+                      "larger than the maximum message size", file=sys.stderr)
+                continue
+            total += len(result)
+            attachments.append(Attachment.from_url(url, result))
+        return attachments
@@ -0,0 +1,185 @@
+# This file is part of hubmail.
+# SPDX-License-Identifier: LGPL-2.1-or-later
+
+import re
+import json
+import asyncio
+
+from typing import (Any, Awaitable, Callable, Dict, List, Mapping, Set,
+                    Tuple)
+from hubmail.queries import Queries
+
+# Lookups that can be batched, and the variables that differ between the
+# lookups merged into one query (the others are shared by the whole batch)
+BATCHED_VARIABLES = {
+    "Issue": ("user", "repo", "number"),
+    "PullRequest": ("user", "repo", "number"),
+    "IssueTimeline": ("id", "cursor"),
+    "IssueTimelineFromEnd": ("id", "cursor"),
+    "IssueTimelineSince": ("id", "cursor"),
+    "PullRequestTimeline": ("id", "cursor"),
+    "PullRequestTimelineFromEnd": ("id", "cursor"),
+    "PullRequestTimelineSince": ("id", "cursor"),
+    "ReviewComments": ("id", "cursor"),
+    "PullRequestCommits": ("id", "cursor"),
+}
+
+# GitHub rejects queries that could return more than 500,000 nodes, and
+# charges about one point per 100 connections requested; batches are kept far
+# below the node limit so that responses stay reasonably small, and large
+# enough that a batch costs about as much as a single lookup
+MAX_LOOKUPS = 50
+MAX_NODES = 10000
+
+REGEX_OPERATION = re.compile(r"^query \w+\((.*?)\) \{(.*)\}$",
+                             flags=re.DOTALL)
+REGEX_RATE_LIMIT = re.compile(r"^\s*\.\.\. rateLimit,?\s*$",
+                              flags=re.MULTILINE)
+
+Lookup = Tuple[Mapping[str, Any], "asyncio.Future[Any]"]
+
+class QueryBatcher:
+    """Merges lookups of the same operation into one query, selecting the
+    result of each lookup under its own alias
+
+    A lookup is sent right away (along with any made in the same iteration of
+    the event loop) unless a batch of the same operation is in flight; then
+    it waits for that batch to finish, so that lookups made meanwhile are
+    sent together.
+
+    run(opname, query, variables) sends a query and returns its result,
+    including any errors.
+    """
+    def __init__(self, queries: Queries,
+                 run: Callable[[str, str, Dict[str, Any]], Awaitable[Any]]
+                 ) -> None:
+        self.queries = queries
+        self.run = run
+        self.pending: Dict[Tuple[str, str], List[Lookup]] = {}
+        self.in_flight: Dict[Tuple[str, str], int] = {}
+        self.documents: Dict[Tuple[str, int], Tuple[str, str]] = {}
+        self.tasks: Set["asyncio.Future[None]"] = set()
+
+    async def query(self, opname: str, variables: Mapping[str, Any]) -> Any:
+        """Looks up one result of the operation opname, returning it in the
+        same form as the unbatched query would"""
+        batched = BATCHED_VARIABLES[opname]
+        shared = {name: value for name, value in variables.items()
+                  if name not in batched}
+        key = (opname, json.dumps(shared, sort_keys=True))
+        future = asyncio.get_running_loop().create_future()
+        lookups = self.pending.setdefault(key, [])
+        if lookups and (len(lookups) >= MAX_LOOKUPS or
+                        _nodes(variables) * (len(lookups) + 1) > MAX_NODES):
+            self._flush(key)
+            lookups = self.pending.setdefault(key, [])
+        lookups.append((variables, future))
+        if len(lookups) == 1 and not self.in_flight.get(key):
+            asyncio.get_running_loop().call_soon(self._flush, key)
+        return await future
+
+    def cancel(self) -> None:
+        """Cancels the lookups not yet sent and the batches in flight, once
+        their results are no longer needed"""
+        for lookups in self.pending.values():
+            for _, future in lookups:
+                future.cancel()
+        self.pending.clear()
+        for task in list(self.tasks):
+            task.cancel()
+
+    def _flush(self, key: Tuple[str, str]) -> None:
+        lookups = self.pending.pop(key, [])
+        if lookups:
+            self.in_flight[key] = self.in_flight.get(key, 0) + 1
+            task = asyncio.ensure_future(self._send(key, lookups))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    def _document(self, opname: str, count: int) -> Tuple[str, str]:
+        """Returns a query selecting count lookups of opname, and the name of
+        the field each lookup selects"""
+        if (opname, count) in self.documents:
+            return self.documents[opname, count]
+        match = REGEX_OPERATION.match(self.queries.definitions[opname])
+        assert match, f"Cannot batch {opname}"
+        parameters = [parameter.strip() for parameter
+                      in match.group(1).replace("\n", " ").split(",")
+                      if parameter.strip()]
+        body = REGEX_RATE_LIMIT.sub("", match.group(2)).strip()
+        field_match = re.match(r"\w+", body)
+        assert field_match
+        batched = re.compile(
+            r"\$({})\b".format("|".join(BATCHED_VARIABLES[opname])))
+        shared_parameters = [parameter for parameter in parameters
+                             if not batched.match(parameter)]
+        fields = []
+        for i in range(count):
+            shared_parameters += [
+                batched.sub(rf"$\g<1>{i}", parameter)
+                for parameter in parameters if batched.match(parameter)]
+            fields.append(f"  t{i}: " + batched.sub(rf"$\g<1>{i}", body))
+        operation = "query {}Batch({}) {{\n{}\n  ... rateLimit,\n}}".format(
+            opname, ", ".join(shared_parameters), "\n".join(fields))
+        document = (self.queries.document(operation), field_match.group(0))
+        self.documents[opname, count] = document
+        return document
+
+    async def _send(self, key: Tuple[str, str],
+                    lookups: List[Lookup]) -> None:
+        try:
+            await self._send_batch(key[0], lookups)
+        finally:
+            self.in_flight[key] -= 1
+            # Send the lookups that waited for this batch
+            if not self.in_flight[key]:
+                self._flush(key)
+
+    async def _send_batch(self, opname: str, lookups: List[Lookup]) -> None:
+        query, field = self._document(opname, len(lookups))
+        variables: Dict[str, Any] = {}
+        for i, (lookup_variables, _) in enumerate(lookups):
+            for name, value in lookup_variables.items():
+                if name in BATCHED_VARIABLES[opname]:
+                    variables[f"{name}{i}"] = value
+                else:
+                    variables[name] = value
+        try:
+            result = await self.run(f"{opname}Batch", query, variables)
+        except Exception as e:
+            for _, future in lookups:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        except BaseException:
+            for _, future in lookups:
+                future.cancel()
+            raise
+        data = result.get("data") or {}
+        errors = result.get("errors", [])
+        # Each lookup is charged its share of the batch, so that it can be
+        # compared with the cost of a single page
+        rate_limit = data.get("rateLimit")
+        if rate_limit and rate_limit.get("cost") is not None:
+            rate_limit = {**rate_limit,
+                          "cost": rate_limit["cost"] / len(lookups)}
+        for i, (_, future) in enumerate(lookups):
+            if future.done():
+                continue
+            # Errors without a path apply to the whole query
+            lookup_errors = [error for error in errors
+                             if (error.get("path") or [f"t{i}"])[0]
+                             == f"t{i}"]
+            lookup_result: Dict[str, Any] = {
+                "data": {field: data.get(f"t{i}")}}
+            if rate_limit:
+                lookup_result["data"]["rateLimit"] = rate_limit
+            if lookup_errors:
+                lookup_result["errors"] = lookup_errors
+            if "elapsed" in result:
+                lookup_result["elapsed"] = result["elapsed"]
+            future.set_result(lookup_result)
+
+def _nodes(variables: Mapping[str, Any]) -> int:
+    """Returns an estimate of how many nodes a lookup may return"""
+    return 1 + (variables.get("numComments") or 0)
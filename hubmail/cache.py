@@ -0,0 +1,104 @@
+# This file is part of hubmail.
+# SPDX-License-Identifier: LGPL-2.1-or-later
+
+import os
+import json
+import sqlite3
+import hashlib
+from time import time
+
+from typing import Optional, NamedTuple, Any
+
+class CacheEntry(NamedTuple):
+    body: bytes
+    etag: Optional[str]
+    stored: float
+
+class ResponseCache:
+    """An on-disk cache of GraphQL results and REST resources (patches and
+    images) in an SQLite database, evicting the least recently used entries
+    once it grows past max_size bytes
+    """
+    def __init__(self, filename: str, max_size: int,
+                 max_age: float) -> None:
+        directory = os.path.dirname(filename)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.db = sqlite3.connect(filename)
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY,
+                body BLOB NOT NULL,
+                etag TEXT,
+                size INTEGER NOT NULL,
+                stored REAL NOT NULL,
+                accessed REAL NOT NULL
+            )""")
+        self.db.execute("""
+            CREATE INDEX IF NOT EXISTS entries_accessed
+            ON entries (accessed)""")
+        self.db.commit()
+        self.max_size = max_size
+        # GraphQL results cannot be revalidated, so they are only reused
+        # for max_age seconds
+        self.max_age = max_age
+        self.size: int = self.db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+
+    def close(self) -> None:
+        self.db.close()
+
+    def get(self, key: str) -> Optional[CacheEntry]:
+        row = self.db.execute(
+            "SELECT body, etag, stored FROM entries WHERE key = ?",
+            (key,)).fetchone()
+        if row is None:
+            return None
+        self.db.execute("UPDATE entries SET accessed = ? WHERE key = ?",
+                        (time(), key))
+        self.db.commit()
+        return CacheEntry(*row)
+
+    def put(self, key: str, body: bytes, etag: Optional[str] = None) -> None:
+        if len(body) > self.max_size:
+            return
+        old = self.db.execute("SELECT size FROM entries WHERE key = ?",
+                              (key,)).fetchone()
+        if old is not None:
+            self.size -= old[0]
+        now = time()
+        self.db.execute(
+            "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)",
+            (key, body, etag, len(body), now, now))
+        self.size += len(body)
+        self._evict()
+        self.db.commit()
+
+    def _evict(self) -> None:
+        if self.size <= self.max_size:
+            return
+        # Evict down to 90% of the maximum so that the next few insertions
+        # do not each trigger an eviction
+        target = self.max_size * 0.9
+        for key, size in self.db.execute(
+                "SELECT key, size FROM entries ORDER BY accessed").fetchall():
+            if self.size <= target:
+                break
+            self.db.execute("DELETE FROM entries WHERE key = ?", (key,))
+            self.size -= size
+
+    @staticmethod
+    def query_key(opname: str, variables: Any) -> str:
+        digest = hashlib.sha256(json.dumps(
+            [opname, variables], sort_keys=True).encode()).hexdigest()
+        return f"graphql:{digest}"
+
+    def get_query(self, opname: str, variables: Any) -> Any:
+        entry = self.get(self.query_key(opname, variables))
+        if entry is None or time() - entry.stored > self.max_age:
+            return None
+        return json.loads(entry.body)
+
+    def put_query(self, opname: str, variables: Any, result: Any) -> None:
+        self.put(self.query_key(opname, variables),
+                 json.dumps(result).encode())
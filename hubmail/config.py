@@ -0,0 +1,58 @@
+# This file is part of hubmail.
+# SPDX-License-Identifier: LGPL-2.1-or-later
+
+from dataclasses import dataclass, field
+
+from typing import List, Optional, Tuple
+
+@dataclass
+class Config:
+    """What to export and how, for use of hubmail as a library (see
+    hubmail.export)
+
+    Each field has the meaning of the command line option of the same name
+    (see hubmail -h), and the same default, except that all comments (or
+    items of the timeline given by timeline) are exported by default.
+    """
+    # What to export, as the subcommand of the same name: "issue", "pull",
+    # "issues", "pulls" or "repos"
+    subcommand: str
+    # The repository, for all but "repos"
+    user: str = ""
+    repo: str = ""
+    # Thread numbers to export, for "issue" and "pull", as inclusive ranges
+    # (an end of None means up to the latest thread)
+    numbers: List[Tuple[int, Optional[int]]] = field(default_factory=list)
+    # Repositories (as USER/REPO) and organizations to export, for "repos"
+    repos: List[str] = field(default_factory=list)
+    org: List[str] = field(default_factory=list)
+    only: Optional[str] = None
+    repo_jobs: int = 4
+
+    # The GitHub token to use [default: $HUBMAIL_TOKEN]
+    token: Optional[str] = None
+    threads: Optional[int] = None
+    comments: Optional[int] = None
+    # The kinds of timeline items to export: "comments", "reviews" and
+    # "events"
+    timeline: List[str] = field(default_factory=lambda: ["comments"])
+    since: Optional[str] = None
+    state: Optional[str] = None
+    wrap: Optional[int] = None
+    extended_subject: bool = False
+    html: bool = False
+    jobs: int = 4
+    render_jobs: int = 0
+    queue_size: int = 64
+    page_size: Optional[int] = None
+    max_image_size: int = 10
+    max_attachments_size: int = 25
+    image_cache_size: int = 64
+    cache: Optional[str] = None
+    cache_size: int = 512
+    cache_max_age: int = 3600
+    connections: int = 20
+    timeout: float = 60
+    retries: int = 5
+    trace: Optional[str] = None
+    api_url: str = "https://api.github.com/graphql"
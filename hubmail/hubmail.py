@@ -5,26 +5,44 @@
 import sys
 import os
 import email.policy
-from email.message import EmailMessage
-from email.headerregistry import Address
 from email.parser import HeaderParser
-from time import time, gmtime, asctime
-from urllib.parse import urlparse
-import textwrap
+from time import gmtime, asctime, perf_counter
 import re
-import mimetypes
-import posixpath
+import asyncio
+import argparse
+from collections import deque
+from contextlib import asynccontextmanager, nullcontext
+from functools import partial
 
 from typing import (Any, Optional, Dict, Literal, List, cast, AsyncIterator,
-                    Union, Tuple)
+                    Union, Tuple, Callable, Awaitable, ContextManager, Deque,
+                    TypeVar, NoReturn, Set)
 from hubmail.types import (QueryVariables, Issue, PullRequest,
-                           IssueOrPullRequestConnection, IssueComment,
-                           IssueCommentConnection, Actor)
-from datetime import datetime
-
-try:
-    from hubmail.mdparse import get_image_urls
-except: pass
+                           IssueOrPullRequestConnection, TimelineItem,
+                           TimelineItemConnection, PullRequestReviewComment,
+                           PullRequestReviewCommentConnection,
+                           PullRequestCommitConnection, Actor,
+                           RepositoryConnection)
+from hubmail.output import Writer, open_output, join_messages
+from hubmail.message import Message, ThreadInfo
+from hubmail.config import Config
+from hubmail.ratelimit import RateLimiter, is_rate_limited
+from hubmail.cache import ResponseCache
+from hubmail.state import SyncState, Checkpoint
+from hubmail.attachments import AttachmentFetcher, TooLargeError
+from hubmail.queries import Queries
+from hubmail.batch import QueryBatcher, MAX_LOOKUPS
+from hubmail.paging import PageSize, QueryTimeoutError
+from hubmail.patches import Patch, PatchSplitter
+from hubmail.timeline import (item_types, review_text, review_comment_text,
+                              event_text)
+from hubmail.render import get_policy, format_email, render_email
+from hubmail.stats import Stats, time_stages
+from hubmail.transport import (Backoff, TransientError, TRANSIENT_ERRORS,
+                               RETRY_STATUSES, SECONDARY_RATE_LIMIT_DELAY,
+                               create_session, is_secondary_rate_limit)
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
 
 import aiohttp
 from dateutil.parser import isoparse
@@ -33,10 +51,9 @@ _QUERY_FILE_NAME = os.path.join(
     os.path.abspath(os.path.dirname(__file__)), "data", "queries.graphql"
 )
 
-with open(_QUERY_FILE_NAME, "r") as queryFile:
-    _QUERY = queryFile.read()
+_QUERIES = Queries(_QUERY_FILE_NAME)
 
-def fatal(*args: Any, **kwargs: Any) -> None:
+def fatal(*args: Any, **kwargs: Any) -> NoReturn:
     print(*args, **kwargs, file=sys.stderr) # type: ignore
     sys.exit(1)
 
@@ -46,23 +63,48 @@ NULL_ACTOR: Actor = {
     "email": "",
     "emailOrNull": "",
 }
-REGEX_FROM = re.compile(r"^From", flags=re.MULTILINE)
-REGEX_FROM_SPACE = re.compile(r"^From ", flags=re.MULTILINE)
 REGEX_PATCH = re.compile(r"^\[PATCH( .*?)?]", flags=re.MULTILINE)
 
+T = TypeVar("T", Issue, PullRequest)
+R = TypeVar("R")
+# Page cursor, number of threads before the page, and number of threads of the
+# page written (see Checkpoint)
+Progress = Tuple[Optional[str], int, int]
+
 class Hubmail:
+    """Exports issues and pull requests as described by a Config, or by the
+    arguments parsed from the command line"""
     def __init__(self, arguments: Any) -> None:
+        self.arguments = arguments
         self.type: str = arguments.subcommand
-        self.user: str = arguments.user
-        self.repo: str = arguments.repo
+        self.user: str = ""
+        self.repo: str = ""
+        try:
+            self.user = arguments.user
+            self.repo = arguments.repo
+        except AttributeError:
+            pass
         self.comments: Optional[int] = arguments.comments
+        # Kinds of timeline items exported along with each thread (see
+        # hubmail.timeline)
+        self.timeline: List[str] = arguments.timeline
         self.wrap: Optional[int] = arguments.wrap
         self.extended_subject: bool = arguments.extended_subject
         self.html: bool = arguments.html
+        self.api_url: str = arguments.api_url
+        self.token: Optional[str] = (getattr(arguments, "token", None)
+                                     or os.getenv("HUBMAIL_TOKEN"))
+        self.cache: Optional[ResponseCache] = None
+        if arguments.cache:
+            self.cache = ResponseCache(
+                arguments.cache, arguments.cache_size * 1024 * 1024,
+                arguments.cache_max_age)
 
-        self.number: Optional[int]
+        # Thread numbers to export, as inclusive ranges (an end of None means
+        # up to the latest thread)
+        self.numbers: List[Tuple[int, Optional[int]]] = []
         try:
-            self.number = arguments.number
+            self.numbers = arguments.numbers
         except AttributeError:
             pass
 
@@ -72,55 +114,564 @@ class Hubmail:
         except AttributeError:
             pass
 
+        self.jobs: int = 1
+        try:
+            self.jobs = max(arguments.jobs, 1)
+        except AttributeError:
+            pass
+
+        # Export of many repositories (USER/REPO names and organizations)
+        self.repos: List[str] = []
+        self.orgs: List[str] = []
+        self.repo_subcommands = ["issues", "pulls"]
+        self.repo_jobs = 1
+        try:
+            # Each repository and organization is exported once
+            self.repos = list(dict.fromkeys(arguments.repos))
+            self.orgs = list(dict.fromkeys(arguments.org))
+            for name in self.repos:
+                user, _, repo = name.partition("/")
+                if not user or not repo or "/" in repo:
+                    raise ValueError(
+                        f"Invalid repository {name!r} (expected USER/REPO)")
+            if arguments.only:
+                self.repo_subcommands = [arguments.only]
+            self.repo_jobs = max(arguments.repo_jobs, 1)
+        except AttributeError:
+            pass
+
+        # Incremental export: only threads updated since this time, and only
+        # messages created or edited since this time
+        self.since: Optional[datetime] = None
+        self.state: Optional[SyncState] = None
+        try:
+            since = arguments.since
+            if arguments.state:
+                self.state = SyncState(arguments.state)
+                since = since or self.state.get(self._state_key())
+            if since:
+                self.since = isoparse(since)
+                if self.since.tzinfo is None:
+                    self.since = self.since.replace(tzinfo=timezone.utc)
+        except AttributeError:
+            pass
+        self.high_water: Optional[str] = None
+
+        # Output of the command line (messages are only yielded to library
+        # users; see messages)
+        self.output: Optional[str] = None
+        self.output_format = "mbox"
+        self.shard_size = 1
+        try:
+            self.output = arguments.output
+            self.output_format = arguments.output_format
+            self.shard_size = arguments.shard_size
+        except AttributeError:
+            pass
+
+        # Checkpoints of exports of many threads to a file
+        self.checkpoint: Optional[Checkpoint] = None
+        self.resume = False
+        try:
+            self.resume = arguments.resume
+            if self.output and self.output != "-":
+                self.checkpoint = Checkpoint(self.output, self._state_key())
+        except AttributeError:
+            pass
+        self.writer: Optional[Writer] = None
+        # Cursor of the page of threads most recently fetched, and the number
+        # of threads before that page
+        self.cursor: Optional[str] = None
+        self.threads_before_cursor = 0
+        self.resume_skip = 0
+        self.resume_position: Any = None
+
         self.total_threads = 0
+        self.rate_limiter = RateLimiter()
+        # Connections kept open to each host, seconds to wait for a
+        # connection or for data, and retries of each request after
+        # transient failures (see hubmail.transport)
+        self.connections: int = arguments.connections
+        self.timeout: float = arguments.timeout
+        self.retries: int = arguments.retries
+        self.batcher = QueryBatcher(_QUERIES, self._post_query)
+        # Number of threads and of comments to request per page
+        self.thread_pages = PageSize(arguments.page_size)
+        self.comment_pages = PageSize(arguments.page_size)
+        # Messages buffered for each thread or repository formatted ahead of
+        # the one being output
+        self.queue_size: int = max(arguments.queue_size, 1)
+        # Latencies and totals of each stage, if --stats or --trace was given
+        self.stats: Optional[Stats] = None
+        if getattr(arguments, "stats", False) or arguments.trace:
+            self.stats = Stats(arguments.trace)
+        self.attachments = AttachmentFetcher(
+            partial(self._fetch, stage="image"),
+            arguments.image_cache_size * 1024 * 1024,
+            arguments.max_image_size * 1024 * 1024,
+            arguments.max_attachments_size * 1024 * 1024, self.stats)
+        # Worker processes for rendering messages (see hubmail.render), or
+        # None to render them in this process
+        self.render_jobs: int = arguments.render_jobs
+        self.renderer: Optional[ProcessPoolExecutor] = None
 
-        self.policy = email.policy.default.clone(
-            max_line_length = self.wrap,
-            raise_on_defect = True,
-        )
+        self.policy = get_policy(self.wrap)
         self.patch_policy = email.policy.default.clone(
             max_line_length = None,
             refold_source = "none",
             raise_on_defect = True,
         )
 
-    async def _run_query(self, opname: str, variables: QueryVariables) -> Any:
+    def _timer(self, stage: str,
+               **fields: Any) -> ContextManager[Dict[str, Any]]:
+        """Times the enclosed code as an event of stage if --stats or --trace
+        was given (see Stats.timer)"""
+        if self.stats is None:
+            return nullcontext(fields)
+        return self.stats.timer(stage, **fields)
+
+    def _count_cache(self, name: str, hit: bool) -> None:
+        if self.stats:
+            self.stats.cache(name, hit)
+
+    async def _run_query(self, opname: str, variables: QueryVariables,
+                         retry_timeouts: bool = True) -> Any:
+        """Runs a query, retrying it after timeouts unless retry_timeouts is
+        false (see _run_page)"""
+        if self.cache:
+            cached = self.cache.get_query(opname, _cached(variables))
+            self._count_cache("graphql", cached is not None)
+            if cached is not None:
+                return cached
+        result: Any = await self._retry_timeouts(
+            lambda: self._post_query(opname, _QUERIES[opname],
+                                     cast(Any, variables)),
+            retry_timeouts)
+        assert "errors" not in result, result["errors"]
+        if self.cache:
+            self.cache.put_query(opname, _cached(variables),
+                                 _uncached(result))
+        return result
+
+    async def _run_batched(self, opname: str, variables: QueryVariables,
+                           missing_ok: bool = False,
+                           retry_timeouts: bool = True) -> Any:
+        """Runs a query that looks up one node, batched with other lookups of
+        the same operation (see QueryBatcher)
+
+        If missing_ok is true, a node that does not exist is returned as
+        null rather than treated as an error. Timeouts are retried unless
+        retry_timeouts is false.
+        """
+        if self.cache:
+            cached = self.cache.get_query(opname, _cached(variables))
+            self._count_cache("graphql", cached is not None)
+            if cached is not None:
+                return cached
+        result: Any = await self._retry_timeouts(
+            lambda: self.batcher.query(opname, variables), retry_timeouts)
+        if "errors" in result and missing_ok and all(
+                error.get("type") == "NOT_FOUND"
+                for error in result["errors"]):
+            # Not cached, as the node may be created later
+            return result
+        assert "errors" not in result, result["errors"]
+        if self.cache:
+            self.cache.put_query(opname, _cached(variables),
+                                 _uncached(result))
+        return result
+
+    async def _post_query(self, opname: str, query: str,
+                          variables: Dict[str, Any]) -> Any:
+        """Sends a query, waiting for the rate limit and retrying after
+        transient failures, and returns its result including any errors, and
+        the duration of the request that returned it in seconds as "elapsed"
+        (without the waits and retries before it)
+
+        Raises QueryTimeoutError if GitHub gives up on the query.
+        """
         assert self.session, "No session initialized"
-        async with self.session.post(
-            "https://api.github.com/graphql",
-            json={
-                "query": _QUERY,
-                "variables": variables,
-                "operationName": opname
-            },
-            headers={"Authorization": f"Bearer {self.token}"}
-        ) as resp:
-            assert resp.status == 200
-            result = await resp.json()
-            assert "errors" not in result, result["errors"]
+        backoff = Backoff(self.retries)
+        while True:
+            with self._timer("wait", opname=opname):
+                await self.rate_limiter.acquire_query(opname)
+            try:
+                with self._timer("graphql", opname=opname) as event:
+                    start = perf_counter()
+                    async with self.session.post(
+                        self.api_url,
+                        json={
+                            "query": query,
+                            "variables": variables,
+                            "operationName": opname
+                        },
+                        headers={"Authorization": f"Bearer {self.token}"}
+                    ) as resp:
+                        event["status"] = resp.status
+                        if is_rate_limited(resp.status, resp.headers):
+                            self.rate_limiter["graphql"].exhaust(
+                                self.rate_limiter.reset_time(resp.headers))
+                            continue
+                        if resp.status in (502, 504):
+                            raise QueryTimeoutError(
+                                f"{opname}: HTTP {resp.status}")
+                        await self._check_status(resp)
+                        event["bytes"] = len(await resp.read())
+                        result = await resp.json()
+                        errors = result.get("errors", [])
+                        if any(error.get("type") == "RATE_LIMITED"
+                               for error in errors):
+                            self.rate_limiter["graphql"].exhaust(
+                                self.rate_limiter.reset_time(resp.headers))
+                            continue
+                        if any("timeout" in error.get("message", "")
+                               for error in errors):
+                            raise QueryTimeoutError(f"{opname}: {errors}")
+                    result["elapsed"] = perf_counter() - start
+                    rate_limit = (result.get("data") or {}).get("rateLimit")
+                    event["cost"] = (rate_limit or {}).get("cost") or 0
+            except TransientError as e:
+                await backoff.wait(e, e.minimum_delay)
+                continue
+            except TRANSIENT_ERRORS as e:
+                await backoff.wait(e)
+                continue
+            self.rate_limiter.update_from_query(opname, rate_limit)
             return result
 
+    async def _check_status(self, resp: aiohttp.ClientResponse) -> None:
+        """Raises TransientError for a response worth retrying, or
+        aiohttp.ClientResponseError for any other unsuccessful response"""
+        if resp.status in RETRY_STATUSES:
+            raise TransientError(f"{resp.url}: HTTP {resp.status}")
+        if resp.status == 403 and is_secondary_rate_limit(await resp.text()):
+            raise TransientError(
+                f"{resp.url}: HTTP 403 (secondary rate limit)",
+                SECONDARY_RATE_LIMIT_DELAY)
+        resp.raise_for_status()
+
+    async def _retry_timeouts(self, query: Callable[[], Awaitable[R]],
+                              retry: bool = True) -> R:
+        """Runs a query, retrying it after timeouts if retry is true"""
+        backoff = Backoff(self.retries)
+        while True:
+            try:
+                return await query()
+            except QueryTimeoutError as e:
+                if not retry:
+                    raise
+                await backoff.wait(e)
+
+    async def _run_page(self, opname: str, variables: QueryVariables,
+                        key: Literal["numThreads", "numComments"],
+                        page_size: PageSize, limit: Optional[int] = None,
+                        batched: bool = False) -> Any:
+        """Runs a query for a page of a connection, with variables[key] set
+        to the current page size (at most limit), adapting the page size to
+        how long the query takes and retrying with smaller pages after
+        timeouts (or with the same page, once pages cannot get smaller)"""
+        backoff = Backoff(self.retries)
+        while True:
+            tried = page_size.size
+            size = tried if limit is None else min(tried, limit)
+            variables[key] = size
+            try:
+                result = await (
+                    self._run_batched(opname, variables, retry_timeouts=False)
+                    if batched
+                    else self._run_query(opname, variables,
+                                         retry_timeouts=False))
+            except QueryTimeoutError as e:
+                # The work a page of threads takes grows with both the number
+                # of threads and the number of comments embedded in each, so
+                # the larger of the two is halved
+                if (key == "numThreads"
+                        and variables.get("numComments", 0) > size
+                        and self.comment_pages.shrink(
+                            variables["numComments"])):
+                    variables.update(self._comment_variables())
+                elif not page_size.shrink(size):
+                    await backoff.wait(e)
+                continue
+            # Only the request itself is timed, as time spent waiting for the
+            # batch to be sent, for the rate limit or before retries says
+            # nothing about the size of the page
+            elapsed = result.pop("elapsed", None)
+            if elapsed is not None:
+                page_size.update(tried, elapsed,
+                                 (result["data"].get("rateLimit") or {})
+                                 .get("cost"))
+            return result
+
+    @asynccontextmanager
+    async def _get(
+        self, url: str, headers: Optional[Dict[str, str]] = None
+    ) -> AsyncIterator[aiohttp.ClientResponse]:
+        """Sends a GET request for a REST resource (e.g. a patch or an image),
+        waiting if the rate limit of its host has been reached, and retrying
+        after transient failures until a response is received
+
+        Raises aiohttp.ClientResponseError for an unsuccessful response other
+        than 304.
+        """
+        backoff = Backoff(self.retries)
+        while True:
+            await self.rate_limiter.for_url(url).acquire()
+            try:
+                resp = await self.session.get(url, headers=headers)
+            except TRANSIENT_ERRORS as e:
+                await backoff.wait(e)
+                continue
+            try:
+                self.rate_limiter.update_from_headers(url, resp.headers)
+                if is_rate_limited(resp.status, resp.headers):
+                    self.rate_limiter.for_url(url).exhaust(
+                        self.rate_limiter.reset_time(resp.headers))
+                    resp.release()
+                    continue
+                await self._check_status(resp)
+            except TransientError as e:
+                resp.release()
+                await backoff.wait(e, e.minimum_delay)
+                continue
+            except BaseException:
+                resp.release()
+                raise
+            break
+        # The response is yielded outside of the loop, so that an exception
+        # raised by the caller (or the generator being closed) cannot be
+        # mistaken for a failure to retry
+        async with resp:
+            yield resp
+
+    async def _fetch(self, url: str, max_size: Optional[int] = None,
+                     stage: str = "download") -> bytes:
+        """Downloads a REST resource, revalidating the cached copy (if any)
+        with its ETag, and raising TooLargeError if it is larger than max_size
+        bytes"""
+        entry = self.cache.get(url) if self.cache else None
+        if entry and max_size is not None and len(entry.body) > max_size:
+            raise TooLargeError(url)
+        headers = ({"If-None-Match": entry.etag}
+                   if entry and entry.etag else None)
+        with self._timer(stage, url=url) as event:
+            async with self._get(url, headers) as resp:
+                event["status"] = resp.status
+                if self.cache:
+                    self._count_cache(stage, resp.status == 304)
+                if resp.status == 304 and entry:
+                    return entry.body
+                if max_size is None:
+                    body = await resp.read()
+                else:
+                    if (resp.content_length is not None
+                            and resp.content_length > max_size):
+                        raise TooLargeError(url)
+                    chunks = []
+                    size = 0
+                    async for chunk in resp.content.iter_any():
+                        size += len(chunk)
+                        if size > max_size:
+                            raise TooLargeError(url)
+                        chunks.append(chunk)
+                    body = b"".join(chunks)
+                event["bytes"] = len(body)
+        if self.cache:
+            self.cache.put(url, body, resp.headers.get("ETag"))
+        return body
+
+    async def _stream(self, url: str,
+                      stage: str = "download") -> AsyncIterator[bytes]:
+        """Downloads a REST resource in chunks as they arrive, revalidating
+        the cached copy (if any) with its ETag
+
+        The whole resource is only kept in memory if it is to be cached, i.e.
+        if it is no larger than the cache.
+        """
+        entry = self.cache.get(url) if self.cache else None
+        headers = ({"If-None-Match": entry.etag}
+                   if entry and entry.etag else None)
+        start = perf_counter()
+        # Time spent by the caller between chunks, which is not part of the
+        # download
+        paused = 0.0
+        async with self._get(url, headers) as resp:
+            status = resp.status
+            if self.cache:
+                self._count_cache(stage, status == 304)
+            if status == 304 and entry:
+                chunks: Optional[List[bytes]] = None
+                size = len(entry.body)
+                yield entry.body
+            else:
+                chunks = [] if self.cache else None
+                size = 0
+                async for chunk in resp.content.iter_any():
+                    size += len(chunk)
+                    if chunks is not None and self.cache:
+                        if size > self.cache.max_size:
+                            chunks = None
+                        else:
+                            chunks.append(chunk)
+                    pause = perf_counter()
+                    yield chunk
+                    paused += perf_counter() - pause
+            etag = resp.headers.get("ETag")
+        if self.stats:
+            self.stats.record(stage, perf_counter() - start - paused,
+                              url=url, status=status, bytes=size)
+        if chunks is not None and self.cache:
+            self.cache.put(url, b"".join(chunks), etag)
+
+    def _is_pull_request(self) -> bool:
+        return self.type in ("pull", "pulls")
+
+    def _item_types(self) -> List[str]:
+        """Returns the types of timeline items to export with each thread"""
+        if self.comments == 0:
+            return []
+        return item_types(self.timeline, self._is_pull_request())
+
+    def _comment_variables(self) -> QueryVariables:
+        """Returns the variables for fetching the first page of the timeline
+        (comments, reviews and events) along with each thread"""
+        num_comments = (abs(self.comments) if self.comments is not None
+                        else None)
+        types = self._item_types()
+        return {
+            "numComments": (
+                self.comment_pages.size if num_comments is None
+                else min(self.comment_pages.size, num_comments)
+            ),
+            # Items updated since the last export are fetched separately
+            "firstComments": self.since is None and bool(types) and (
+                self.comments is None or self.comments > 0),
+            "lastComments": self.since is None and bool(types) and (
+                self.comments is not None and self.comments < 0),
+            "itemTypes": types,
+        }
+
+    def _state_key(self) -> str:
+        return f"{self.user}/{self.repo}/{self.type}"
+
+    def _is_new(self, node: Union[Issue, PullRequest, TimelineItem,
+                                  PullRequestReviewComment],
+                submitted_at: Optional[str] = None) -> bool:
+        """Returns whether a thread, comment, review or event was created or
+        edited since the last export, or submitted since then at
+        submitted_at (for reviews and their comments, which are created
+        pending and only become visible once the review is submitted)
+
+        The comparison is strict, as the state file records the latest
+        update that was exported, which must not be exported again.
+        """
+        if self.since is None:
+            return True
+        since = self.since
+        return any(timestamp and isoparse(timestamp) > since
+                   for timestamp in (node["createdAt"],
+                                     node.get("lastEditedAt"), submitted_at))
+
+    def _is_updated(self, node: Union[Issue, PullRequest]) -> bool:
+        return self.since is None or isoparse(node["updatedAt"]) > self.since
+
+    def _record_update(self, thread: Union[Issue, PullRequest]) -> None:
+        """Raises the high-water mark saved to the state file to the update
+        time of a thread being exported"""
+        if (self.high_water is None or isoparse(thread["updatedAt"])
+                > isoparse(self.high_water)):
+            self.high_water = thread["updatedAt"]
+
     async def _get_thread(
         self, thread_type: Literal["issue", "pullRequest"], user: str,
         repo: str, number: int
     ) -> Union[Issue, PullRequest]:
+        result = await self._find_thread(thread_type, user, repo, number)
+        assert result is not None
+        return result
+
+    async def _find_thread(
+        self, thread_type: Literal["issue", "pullRequest"], user: str,
+        repo: str, number: int, missing_ok: bool = False
+    ) -> Optional[Union[Issue, PullRequest]]:
         query = thread_type[0].upper() + thread_type[1:]
         variables: QueryVariables = {
             "user": user,
             "repo": repo,
             "number": number,
             "html": self.html,
+            **self._comment_variables(),
         }
-        result = cast(Union[Issue, PullRequest],
-                      (await self._run_query(query, variables))
-                      ["data"]["repository"][thread_type])
-        assert result is not None
-        return result
+        return cast(Optional[Union[Issue, PullRequest]],
+                    (await self._run_batched(query, variables, missing_ok))
+                    ["data"]["repository"][thread_type])
+
+    async def _get_numbered_threads(
+        self, thread_type: Literal["issue", "pullRequest"], user: str,
+        repo: str
+    ) -> AsyncIterator[List[Union[Issue, PullRequest]]]:
+        """Gets the threads with the numbers in self.numbers, in that order,
+        looking up a batch of them at a time
+
+        Numbers in ranges that are not threads of thread_type (e.g. pull
+        requests when exporting issues) are skipped.
+        """
+        latest = 0
+        if any(end is None for _, end in self.numbers):
+            latest = await self._get_latest_number(thread_type, user, repo)
+        explicit = {start for start, end in self.numbers if start == end}
+        seen = set()
+        batch: List[int] = []
+        for start, end in self.numbers:
+            for number in range(start, (latest if end is None else end) + 1):
+                if number in seen:
+                    continue
+                seen.add(number)
+                batch.append(number)
+                if len(batch) < MAX_LOOKUPS:
+                    continue
+                yield await self._find_threads(thread_type, user, repo,
+                                               batch, explicit)
+                batch = []
+        if batch:
+            yield await self._find_threads(thread_type, user, repo, batch,
+                                           explicit)
+
+    async def _find_threads(
+        self, thread_type: Literal["issue", "pullRequest"], user: str,
+        repo: str, numbers: List[int], explicit: Set[int]
+    ) -> List[Union[Issue, PullRequest]]:
+        threads = await asyncio.gather(*(
+            self._find_thread(thread_type, user, repo, number,
+                              missing_ok=True)
+            for number in numbers))
+        name = "issue" if thread_type == "issue" else "pull request"
+        for number, thread in zip(numbers, threads):
+            if thread is None and number in explicit:
+                print(f"hubmail: {user}/{repo} has no {name} #{number}",
+                      file=sys.stderr)
+        return [thread for thread in threads if thread is not None]
+
+    async def _get_latest_number(
+        self, thread_type: Literal["issue", "pullRequest"], user: str,
+        repo: str
+    ) -> int:
+        repository = (await self._run_query("LatestNumbers", {
+            "user": user, "repo": repo,
+        }))["data"]["repository"]
+        nodes = repository["issues" if thread_type == "issue"
+                           else "pullRequests"]["nodes"]
+        return nodes[0]["number"] if nodes else 0
 
     async def _get_threads(
         self, threads_type: Literal["issues", "pullRequests"], user: str,
         repo: str
     ) -> AsyncIterator[List[Union[Issue, PullRequest]]]:
+        if self.since is not None:
+            async for threads in self._get_updated_threads(
+                    threads_type, user, repo):
+                yield threads
+            return
         query = threads_type[0].upper() + threads_type[1:]
         # Get threads from end (reverse order) if negative number of threads
         # specified
@@ -132,19 +683,22 @@ class Hubmail:
         num_threads = abs(self.threads) if self.threads is not None else None
         variables: QueryVariables = {
             "user": user, "repo": repo,
-            "numThreads": (
-                20 if num_threads is None or num_threads >= 20
-                else num_threads
-            ),
-            "cursor": None,
+            "cursor": self.cursor,
             "html": self.html,
         }
         while True:
+            variables.update(self._comment_variables())
             result = cast(IssueOrPullRequestConnection,
-                          (await self._run_query(query, variables))
+                          (await self._run_page(
+                              query, variables, "numThreads",
+                              self.thread_pages,
+                              None if num_threads is None
+                              else num_threads - self.total_threads))
                           ["data"]["repository"][threads_type])
             if reverse_order:
                 result["nodes"] = result["nodes"][::-1]
+            self.cursor = variables["cursor"]
+            self.threads_before_cursor = self.total_threads
             self.total_threads += len(result["nodes"])
             if num_threads is None or self.total_threads <= num_threads:
                 yield result["nodes"] or []
@@ -152,245 +706,819 @@ class Hubmail:
                 # Remove the excess threads
                 yield result["nodes"][:-(self.total_threads - num_threads)]
                 break
+            if (num_threads is not None and self.total_threads >= num_threads
+                    or not result["pageInfo"].get("hasNextPage", True)):
+                break
             variables["cursor"] = result["pageInfo"]["nextCursor"]
             if not variables["cursor"]:
                 break
 
-    async def _get_comments(self, id: str) -> AsyncIterator[List[IssueComment]]:
-        # Get threads from end (reverse order) if negative number of comments
-        # specified
-        if self.comments is not None and self.comments < 0:
-            query = "CommentsFromEnd"
-            reverse_order = True
-        else:
-            query = "Comments"
-            reverse_order = False
-        num_comments = (abs(self.comments) if self.comments is not None
-                        else None)
+    async def _get_updated_threads(
+        self, threads_type: Literal["issues", "pullRequests"], user: str,
+        repo: str
+    ) -> AsyncIterator[List[Union[Issue, PullRequest]]]:
+        """Gets the threads updated since self.since, least recently updated
+        first"""
+        assert self.since is not None
+        query = threads_type[0].upper() + threads_type[1:] + "Since"
         variables: QueryVariables = {
-            "id": id,
-            "numComments": (
-                20 if num_comments is None or num_comments >= 20
-                else num_comments
-            ),
+            "user": user, "repo": repo,
+            "cursor": self.cursor if threads_type == "issues" else None,
+            "html": self.html,
+        }
+        if threads_type == "issues":
+            variables["since"] = self.since.isoformat()
+        # Pull requests cannot be filtered by update time, so they are fetched
+        # most recently updated first until an older one is reached
+        updated_pulls: List[Union[Issue, PullRequest]] = []
+        while True:
+            result = cast(IssueOrPullRequestConnection,
+                          (await self._run_page(query, variables, "numThreads",
+                                                self.thread_pages))
+                          ["data"]["repository"][threads_type])
+            nodes = [node for node in result["nodes"]
+                     if self._is_updated(node)]
+            if threads_type == "issues":
+                self.cursor = variables["cursor"]
+                yield nodes
+            else:
+                updated_pulls += nodes
+                if len(nodes) < len(result["nodes"]):
+                    break
+            if not result["pageInfo"].get("hasNextPage", True):
+                break
+            variables["cursor"] = result["pageInfo"]["nextCursor"]
+            if not variables["cursor"]:
+                break
+        if updated_pulls:
+            self.cursor = None
+            yield updated_pulls[::-1]
+
+    async def _get_timeline(
+        self, thread: Union[Issue, PullRequest]
+    ) -> AsyncIterator[List[TimelineItem]]:
+        """Gets the comments, reviews and events on a thread, a page at a
+        time, in order of creation"""
+        query = ("PullRequestTimeline" if self._is_pull_request()
+                 else "IssueTimeline")
+        variables: QueryVariables = {
+            "id": thread["id"],
             "cursor": None,
             "html": self.html,
+            "itemTypes": self._item_types(),
         }
+        result: Optional[TimelineItemConnection] = None
+        num_comments = (abs(self.comments) if self.comments is not None
+                        else None)
+        reverse_order = False
+        if self.since is not None:
+            # All items updated since the last export
+            query += "Since"
+            variables["since"] = self.since.isoformat()
+            num_comments = None
+        elif self.comments is not None and self.comments < 0:
+            # Get the latest items (in reverse order) if a negative number of
+            # comments was given
+            query += "FromEnd"
+            reverse_order = True
+        if self.since is None:
+            # The first page is fetched along with the thread
+            result = cast(
+                Optional[TimelineItemConnection],
+                thread.get("timelineFromEnd" if reverse_order
+                           else "timeline"))
         total_comments = 0
         while True:
-            result = cast(IssueCommentConnection,
-                          (await self._run_query(query, variables))
-                          ["data"]["node"]["comments"])
+            if result is None:
+                result = cast(TimelineItemConnection,
+                              (await self._run_page(
+                                  query, variables, "numComments",
+                                  self.comment_pages,
+                                  None if num_comments is None
+                                  else num_comments - total_comments,
+                                  batched=True))
+                              ["data"]["node"]["timelineItems"])
             if reverse_order:
                 result["nodes"] = result["nodes"][::-1]
             total_comments += len(result["nodes"])
             if num_comments is None or total_comments <= num_comments:
                 yield result["nodes"] or []
             else:
-                # Remove the excess comments
+                # Remove the excess items
                 yield result["nodes"][:-(total_comments - num_comments)]
                 break
-            # Get new cursor; break if end of comments reached
+            # Stop if enough items were fetched or none are left
+            if (num_comments is not None and total_comments >= num_comments
+                    or not result["pageInfo"].get("hasNextPage", True)):
+                break
+            # Get new cursor; break if end of timeline reached
+            variables["cursor"] = result["pageInfo"]["nextCursor"]
+            if not variables["cursor"]:
+                break
+            result = None
+
+    async def _get_review_comments(
+        self, review: TimelineItem
+    ) -> List[PullRequestReviewComment]:
+        """Gets the comments on lines of a pull request made by a review"""
+        variables: QueryVariables = {
+            "id": review["id"],
+            "cursor": None,
+            "html": self.html,
+        }
+        comments: List[PullRequestReviewComment] = []
+        while True:
+            result = cast(PullRequestReviewCommentConnection,
+                          (await self._run_page(
+                              "ReviewComments", variables, "numComments",
+                              self.comment_pages, batched=True))
+                          ["data"]["node"]["comments"])
+            comments += result["nodes"]
+            if not result["pageInfo"].get("hasNextPage", True):
+                break
+            variables["cursor"] = result["pageInfo"]["nextCursor"]
+            if not variables["cursor"]:
+                break
+        return comments
+
+    async def _get_new_commits(self, pull: PullRequest) -> Set[str]:
+        """Gets the hashes of the commits of a pull request committed since
+        self.since
+
+        The commit date is used rather than the author date (the only date
+        in the patch), as it changes when commits are rebased or amended.
+        """
+        assert self.since is not None
+        variables: QueryVariables = {"id": pull["id"], "cursor": None}
+        commits: Set[str] = set()
+        while True:
+            result = cast(PullRequestCommitConnection,
+                          (await self._run_page(
+                              "PullRequestCommits", variables, "numComments",
+                              self.comment_pages, batched=True))
+                          ["data"]["node"]["commits"])
+            commits.update(node["commit"]["oid"] for node in result["nodes"]
+                           if isoparse(node["commit"]["committedDate"])
+                           > self.since)
+            if not result["pageInfo"].get("hasNextPage", True):
+                break
             variables["cursor"] = result["pageInfo"]["nextCursor"]
             if not variables["cursor"]:
                 break
+        return commits
+
+    async def _render(self, function: Callable[..., R], *args: Any) -> R:
+        """Runs a function from hubmail.render, in a worker process if
+        --render-jobs was given, recording the time spent in each of its
+        stages if --stats or --trace was given"""
+        if self.stats is None:
+            return await self._run_render(function, *args)
+        with self.stats.timer("render", function=function.__name__):
+            result, stages = await self._run_render(time_stages, function,
+                                                    *args)
+        for stage, elapsed in stages.items():
+            self.stats.record(stage, elapsed)
+        return result
+
+    async def _run_render(self, function: Callable[..., R], *args: Any) -> R:
+        if self.renderer is None:
+            return function(*args)
+        return await asyncio.get_running_loop().run_in_executor(
+            self.renderer, function, *args)
 
-    async def _format_email(self, name: str, address: str, timestamp: datetime,
-                            subject: str, body: str, message_id: str, *,
+    async def _format_email(self, thread_info: ThreadInfo, name: str,
+                            address: str, timestamp: datetime, subject: str,
+                            body: str, message_id: str, *,
                             in_reply_to: str = "", references: str = "",
-                            html: Optional[str] = None) -> str:
-        body = body.replace("\r\n", "\n")
-
-        cols = self.wrap or 0
-        if cols > 0:
-            body = "\n".join(
-                textwrap.fill(
-                    line, cols, expand_tabs=False, replace_whitespace=False,
-                    break_long_words=False, break_on_hyphens=False,
-                    subsequent_indent=(
-                        "> " if line.startswith("> ")
-                        else ">" if line.startswith(">")
-                        else ""))
-                for line in body.splitlines())
-
-        # Replace "From" at the beginning of a line with ">From"
-        # (see https://www.jwz.org/doc/content-length.html)
-        body = REGEX_FROM.sub(r">From", body)
-
-        msg = EmailMessage(policy=self.policy)
-        msg.set_content(body)
-
-        if html:
-            msg.add_alternative(html, subtype="html")
-
-        # Identify image URLs and add the images as attachments
-        try:
-            for url in get_image_urls(body):
-                async with self.session.get(url) as resp:
-                    assert resp.status == 200
-                    img_data: bytes = await resp.read()
-                    maintype, subtype = (mimetypes.guess_type(url)[0] or
-                                         "application/octet-stream").split("/")
-                    filename = posixpath.basename(urlparse(url).path)
-                    msg.add_attachment(
-                        img_data, maintype=maintype, subtype=subtype,
-                        filename=filename
-                    )
-        except:
-            pass
+                            html: Optional[str] = None) -> Message:
+        text, body, image_urls = await self._render(
+            format_email, self.wrap, name, address, timestamp, subject, body,
+            message_id, in_reply_to, references, html)
+        if text is None:
+            # Add the linked images as attachments
+            attachments = await self.attachments.fetch_all(image_urls)
+            text = await self._render(
+                render_email, self.wrap, name, address, timestamp, subject,
+                body, message_id, in_reply_to, references, html, attachments)
+        return Message.create(text, thread_info, message_id, in_reply_to)
 
-        try:
-            msg["From"] = Address(name, addr_spec=address)
-        except IndexError:
-            msg["From"] = Address(name)
-        msg["Date"] = timestamp
-        msg["Subject"] = subject
-        if message_id:
-            msg["Message-ID"] = message_id
-        if in_reply_to:
-            msg["In-Reply-To"] = in_reply_to
-
-        if references and in_reply_to:
-            msg["References"] = f"{references} {in_reply_to}"
-        elif references:
-            msg["References"] = references
-        elif in_reply_to:
-            msg["References"] = in_reply_to
-
-        # For some reason as_string does not include the unixfrom line
-        # and as_bytes uses the quoted-printable encoding despite purportedly
-        # supporting native Unicode.
-        return msg.as_bytes(policy=self.policy, unixfrom=True).decode()
-
-    async def _format_issue(self, user: str, repo: str, issue: Issue) -> str:
+    async def _format_issue(self, user: str, repo: str,
+                            issue: Issue) -> AsyncIterator[Message]:
         number = issue["number"]
-        author = issue["author"] or NULL_ACTOR
-        assert number and author
+        assert number
         subject = (f"[{user}/{repo}] {issue['title']} (#{number})"
                    if self.extended_subject else issue["title"])
+        thread_info = (user, repo, "issues", str(number))
+        self._record_update(issue)
         html = issue["bodyHTML"] if self.html else None
-        result = await self._format_email(
-            author.get("name") or author.get("login") or "",
-            author.get("email") or author.get("emailOrNull") or "",
-            isoparse(issue["createdAt"]), subject, issue["body"],
-            f"<{user}/{repo}/issues/{number}@github.com>", html=html)
-        if self.comments == 0:
-            return result
-        return result + "\n\n".join([i async for i in self._format_comments(
-            issue["id"], f"Re: {subject}",
-            (user, repo, "issues", str(number)))])
+        if self._is_new(issue):
+            yield await self._format_email(
+                thread_info,
+                *_name_and_address(issue["author"]),
+                isoparse(issue["createdAt"]), subject, issue["body"],
+                f"<{'/'.join(thread_info)}@github.com>", html=html)
+        if not self._item_types():
+            return
+        async with _aclosing(self._format_timeline(
+                issue, f"Re: {subject}", thread_info)) as messages:
+            async for message in messages:
+                yield message
 
     async def format_issue(self, user: str, repo: str, number: int) -> str:
+        return join_messages([i.text async for i in self._iter_issue(
+            user, repo, number)])
+
+    async def _iter_issue(self, user: str, repo: str,
+                          number: int) -> AsyncIterator[Message]:
         issue = cast(Issue,
                      await self._get_thread("issue", user, repo, number))
-        return await self._format_issue(user, repo, issue)
+        async for message in self._format_issue(user, repo, issue):
+            yield message
 
     async def _format_pull(self, user: str, repo: str,
-                           pull: PullRequest) -> str:
+                           pull: PullRequest) -> AsyncIterator[Message]:
         number = pull["number"]
-        author = pull["author"] or NULL_ACTOR
-        assert number and author
+        assert number
         subject = (f"[{user}/{repo}] {pull['title']} (#{number})"
                    if self.extended_subject else pull["title"])
         thread_info = (user, repo, "pull", str(number))
+        self._record_update(pull)
         message_id = f"<{'/'.join(thread_info)}@github.com>"
         html = pull["bodyHTML"] if self.html else None
-        result = await self._format_email(
-            author.get("name") or author.get("login") or "",
-            author.get("email") or author.get("emailOrNull") or "",
-            isoparse(pull["createdAt"]), subject, pull["body"],
-            message_id, html=html)
-
-        # Get pull request patches
-        async with self.session.get(f"{pull['url']}.patch") as resp:
-            assert resp.status == 200
-            for rawtext in REGEX_FROM_SPACE.split(await resp.text())[1:]:
-
-                unixfrom, text = rawtext.split("\n", 1)
-                commit_sha = unixfrom.split(" ", 1)[0]
-
-                # Keep headers separate from body so that patch is not mangled
-                # (e.g. if patch contains CRLF, don't convert to LF)
-                headers, body = text.split("\n\n", 1)
-                msg = HeaderParser(policy=self.patch_policy).parsestr(headers)
-                if self.extended_subject:
-                    msg_subject = msg["Subject"]
-                    del msg["Subject"]
-                    msg["Subject"] = REGEX_PATCH.sub(
-                        r"[PATCH {}/{}#{}\1]".format(user, repo, number),
-                        msg_subject)
-                msg["Message-ID"] = (
-                    f"<{'/'.join(thread_info)}/{commit_sha}@github.com>")
-                msg["In-Reply-To"] = message_id
-                msg["References"] = message_id
-                result += (
-                    "\n" + "From " + unixfrom + "\n"
-                    + msg.as_string(policy=self.policy) + body)
+        is_new = self._is_new(pull)
+        # Only the commits made since the last export are exported for pull
+        # requests that were exported before
+        new_commits = (None if is_new or self.since is None
+                       else await self._get_new_commits(pull))
+        if is_new:
+            yield await self._format_email(
+                thread_info,
+                *_name_and_address(pull["author"]),
+                isoparse(pull["createdAt"]), subject, pull["body"],
+                message_id, html=html)
 
-        if self.comments == 0:
-            return result
-        return result + "\n".join([i async for i in self._format_comments(
-            pull["id"], f"Re: {subject}", thread_info)])
+        # Get pull request patches, splitting them into commits as they are
+        # downloaded, unless none of the commits is new
+        if new_commits is None or new_commits:
+            splitter = PatchSplitter()
+            async with _aclosing(
+                    self._stream(f"{pull['url']}.patch", "patch")) as chunks:
+                async for chunk in chunks:
+                    for patch in splitter.feed(chunk):
+                        message = self._format_commit(patch, user, repo, pull,
+                                                      new_commits)
+                        if message is not None:
+                            yield message
+            for patch in splitter.close():
+                message = self._format_commit(patch, user, repo, pull,
+                                              new_commits)
+                if message is not None:
+                    yield message
+
+        if not self._item_types():
+            return
+        async with _aclosing(self._format_timeline(
+                pull, f"Re: {subject}", thread_info)) as messages:
+            async for message in messages:
+                yield message
+
+    def _format_commit(
+        self, patch: Patch, user: str, repo: str, pull: PullRequest,
+        new_commits: Optional[Set[str]]
+    ) -> Optional[Message]:
+        """Formats one commit of a pull request, or returns None if it is not
+        in new_commits (unless that is None, for all commits)"""
+        number = pull["number"]
+        thread_info = (user, repo, "pull", str(number))
+        message_id = f"<{'/'.join(thread_info)}@github.com>"
+        commit_sha = patch.unixfrom.split(" ", 1)[0]
+        if new_commits is not None and commit_sha not in new_commits:
+            return None
+        msg = HeaderParser(policy=self.patch_policy).parsestr(patch.headers)
+        if self.extended_subject:
+            msg_subject = msg["Subject"]
+            del msg["Subject"]
+            msg["Subject"] = REGEX_PATCH.sub(
+                r"[PATCH {}/{}#{}\1]".format(user, repo, number),
+                msg_subject)
+        commit_message_id = (
+            f"<{'/'.join(thread_info)}/{commit_sha}@github.com>")
+        msg["Message-ID"] = commit_message_id
+        msg["In-Reply-To"] = message_id
+        msg["References"] = message_id
+        return Message.create(
+            "From " + patch.unixfrom + "\n"
+            + msg.as_string(policy=self.policy) + patch.body,
+            thread_info, commit_message_id, message_id)
 
     async def format_pull(self, user: str, repo: str, number: int) -> str:
+        return join_messages([i.text async for i in self._iter_pull(
+            user, repo, number)])
+
+    async def _iter_pull(self, user: str, repo: str,
+                         number: int) -> AsyncIterator[Message]:
         pull = cast(PullRequest,
                     await self._get_thread("pullRequest", user, repo, number))
-        return await self._format_pull(user, repo, pull)
+        async for message in self._format_pull(user, repo, pull):
+            yield message
+
+    async def _format_threads(
+        self, threads: AsyncIterator[List[T]],
+        formatter: Callable[[T], AsyncIterator[Message]]
+    ) -> AsyncIterator[Message]:
+        """Formats up to self.jobs threads at once, yielding the messages in
+        the original order of the threads"""
+        # Threads already written before the checkpoint being resumed from
+        skip = self.resume_skip
+        if self.jobs == 1:
+            # Stream each message as soon as it is formatted
+            async for page in threads:
+                cursor, before = self.cursor, self.threads_before_cursor
+                for index, thread in enumerate(page[skip:], skip):
+                    async for message in formatter(thread):
+                        yield message
+                    self._save_checkpoint(cursor, before, index + 1)
+                # A resumed page may be smaller than the one the checkpoint
+                # was saved from
+                skip = max(0, skip - len(page))
+            return
+
+        # The messages of each pending thread are yielded once it reaches
+        # the front of the queue; until then, up to self.queue_size of them
+        # are buffered and formatting the thread waits for the consumer. The
+        # checkpoint to save once a thread is written is kept alongside it.
+        pending: "Deque[Tuple[_Prefetch, Progress]]" = deque()
+        try:
+            async for page in threads:
+                cursor, before = self.cursor, self.threads_before_cursor
+                for index, thread in enumerate(page[skip:], skip):
+                    pending.append((
+                        _Prefetch(formatter(thread), self.queue_size),
+                        (cursor, before, index + 1)))
+                    if len(pending) >= self.jobs:
+                        prefetch, checkpoint = pending[0]
+                        async for message in prefetch:
+                            yield message
+                        pending.popleft()
+                        self._save_checkpoint(*checkpoint)
+                # A resumed page may be smaller than the one the checkpoint
+                # was saved from
+                skip = max(0, skip - len(page))
+            while pending:
+                prefetch, checkpoint = pending[0]
+                async for message in prefetch:
+                    yield message
+                pending.popleft()
+                self._save_checkpoint(*checkpoint)
+        finally:
+            # Do not leave tasks running if the consumer stops early or a
+            # thread fails to format
+            for prefetch, _ in pending:
+                prefetch.cancel()
+
+    def _save_checkpoint(self, cursor: Optional[str], threads: int,
+                         index: int) -> None:
+        """Records that the threads of the page at cursor up to index have
+        been written"""
+        if self.checkpoint and self.writer:
+            self.checkpoint.save({
+                "cursor": cursor,
+                "threads": threads,
+                "skip": index,
+                "position": self.writer.tell(),
+                "high_water": self.high_water,
+            })
+
+    def _format_issues(self, user: str, repo: str) -> AsyncIterator[Message]:
+        return self._format_threads(
+            cast(AsyncIterator[List[Issue]],
+                 self._get_threads("issues", user, repo)),
+            lambda issue: self._format_issue(user, repo, issue))
 
-    async def _format_issues(self, user: str, repo: str) -> AsyncIterator[str]:
-        async for issues in cast(AsyncIterator[List[Issue]],
-                                 self._get_threads("issues", user, repo)):
-            for issue in issues:
-                yield await self._format_issue(user, repo, issue)
+    def _format_numbered_issues(self, user: str,
+                                repo: str) -> AsyncIterator[Message]:
+        return self._format_threads(
+            cast(AsyncIterator[List[Issue]],
+                 self._get_numbered_threads("issue", user, repo)),
+            lambda issue: self._format_issue(user, repo, issue))
 
     async def format_issues(self, user: str, repo: str) -> str:
-        return "\n\n".join([i async for i in self._format_issues(user, repo)])
+        return join_messages([i.text async for i in self._format_issues(
+            user, repo)])
 
-    async def _format_pulls(self, user: str, repo: str) -> AsyncIterator[str]:
-        async for pulls in cast(AsyncIterator[List[PullRequest]],
-                                self._get_threads("pullRequests", user, repo)):
-            for pull in pulls:
-                yield await self._format_pull(user, repo, pull)
+    def _format_pulls(self, user: str, repo: str) -> AsyncIterator[Message]:
+        return self._format_threads(
+            cast(AsyncIterator[List[PullRequest]],
+                 self._get_threads("pullRequests", user, repo)),
+            lambda pull: self._format_pull(user, repo, pull))
+
+    def _format_numbered_pulls(self, user: str,
+                               repo: str) -> AsyncIterator[Message]:
+        return self._format_threads(
+            cast(AsyncIterator[List[PullRequest]],
+                 self._get_numbered_threads("pullRequest", user, repo)),
+            lambda pull: self._format_pull(user, repo, pull))
 
     async def format_pulls(self, user: str, repo: str) -> str:
-        return "\n\n".join([i async for i in self._format_pulls(user, repo)])
-
-    async def _format_comments(
-        self, id: str, subject: str, thread_info: Tuple[str, str, str, str]
-    ) -> AsyncIterator[str]:
-        user, repo, _, number = thread_info
-        async for comments in self._get_comments(id):
-            result = ""
-            orig_message_id = f"<{'/'.join(thread_info)}@github.com>"
-            for comment in comments:
-                author = comment["author"] or NULL_ACTOR
-                message_id = f"<{'/'.join(thread_info)}/c{comment['databaseId']}@github.com>"
-                html = comment["bodyHTML"] if self.html else None
-                result += "\n\n" + await self._format_email(
-                    author.get("name") or author.get("login") or "",
-                    author.get("email") or author.get("emailOrNull") or "",
-                    isoparse(comment["createdAt"]), subject, comment["body"],
-                    message_id, in_reply_to=orig_message_id, html=html)
-            yield result
+        return join_messages([i.text async for i in self._format_pulls(
+            user, repo)])
+
+    async def _format_timeline(
+        self, thread: Union[Issue, PullRequest], subject: str,
+        thread_info: ThreadInfo
+    ) -> AsyncIterator[Message]:
+        async for items in self._get_timeline(thread):
+            # Format the items of a page concurrently (so that they can be
+            # rendered by several worker processes, and the comments of its
+            # reviews looked up in one query), yielding them in order
+            pending: "Deque[asyncio.Future[List[Message]]]" = deque()
+            try:
+                for item in items:
+                    pending.append(asyncio.ensure_future(
+                        self._format_item(item, subject, thread_info)))
+                while pending:
+                    for message in await pending.popleft():
+                        yield message
+            finally:
+                for future in pending:
+                    future.cancel()
+
+    async def _format_item(self, item: TimelineItem, subject: str,
+                           thread_info: ThreadInfo) -> List[Message]:
+        """Formats a comment, review or event replying to the first message
+        of a thread, unless it was exported before"""
+        if item["type"] == "PullRequestReview":
+            return await self._format_review(item, subject, thread_info)
+        if not self._is_new(item):
+            return []
+        thread_id = "/".join(thread_info)
+        if item["type"] == "IssueComment":
+            message_id = f"<{thread_id}/c{item['databaseId']}@github.com>"
+            author = item["author"]
+            body = item["body"]
+            html = item["bodyHTML"] if self.html else None
+        else:
+            message_id = f"<{thread_id}/e{item['id']}@github.com>"
+            author = item["actor"]
+            body = event_text(item, self._is_pull_request())
+            html = None
+        name, address = _name_and_address(author)
+        return [await self._format_email(
+            thread_info, name, address, isoparse(item["createdAt"]), subject,
+            body, message_id, in_reply_to=f"<{thread_id}@github.com>",
+            html=html)]
+
+    async def _format_review(self, review: TimelineItem, subject: str,
+                             thread_info: ThreadInfo) -> List[Message]:
+        """Formats a review, followed by its comments on lines of the pull
+        request, which reply to the review or to the comments they answer
+        """
+        if review.get("state") == "PENDING":
+            # Only visible to its author until it is submitted
+            return []
+        thread_id = "/".join(thread_info)
+        thread_message_id = f"<{thread_id}@github.com>"
+        message_id = f"<{thread_id}/r{review['databaseId']}@github.com>"
+        text = review_text(review)
+        # The comments of a review without a message reply to the thread
+        parent = thread_message_id if text is None else message_id
+        # Looked up before any message is formatted, so that nothing is left
+        # unawaited if the lookup fails or is cancelled
+        comments = (await self._get_review_comments(review)
+                    if review["comments"]["totalCount"] else [])
+        # A review started before the last export may have been submitted
+        # since then, along with its comments
+        submitted_at = review.get("submittedAt")
+        messages: List[Awaitable[Message]] = []
+        if text is not None and self._is_new(review, submitted_at):
+            name, address = _name_and_address(review["author"])
+            messages.append(self._format_email(
+                thread_info, name, address,
+                isoparse(submitted_at or review["createdAt"]),
+                subject, text, message_id, in_reply_to=thread_message_id,
+                html=review["bodyHTML"] if self.html else None))
+        for comment in comments:
+            if not self._is_new(comment, submitted_at):
+                continue
+            reply_to = comment.get("replyTo")
+            in_reply_to = (
+                f"<{thread_id}/rc{reply_to['databaseId']}@github.com>"
+                if reply_to else parent)
+            name, address = _name_and_address(comment["author"])
+            messages.append(self._format_email(
+                thread_info, name, address, isoparse(comment["createdAt"]),
+                subject, review_comment_text(comment),
+                f"<{thread_id}/rc{comment['databaseId']}@github.com>",
+                in_reply_to=in_reply_to,
+                # In-Reply-To is added to the end of References
+                references=" ".join(
+                    ancestor for ancestor in dict.fromkeys(
+                        [thread_message_id, parent])
+                    if ancestor != in_reply_to),
+                html=comment["bodyHTML"] if self.html else None))
+        return list(await asyncio.gather(*messages))
+
+    async def _get_repos(self) -> AsyncIterator[Tuple[str, str]]:
+        """Gets the owner and name of each repository to export, once even if
+        it is also in one of the organizations"""
+        seen: Set[str] = set()
+        for name in self.repos:
+            # Owner and repository names are case-insensitive
+            if name.lower() in seen:
+                continue
+            seen.add(name.lower())
+            user, _, repo = name.partition("/")
+            yield user, repo
+        for org in self.orgs:
+            variables: QueryVariables = {"org": org, "cursor": None}
+            while True:
+                result = cast(RepositoryConnection,
+                              (await self._run_query(
+                                  "OrganizationRepositories", variables))
+                              ["data"]["organization"]["repositories"])
+                for repository in result["nodes"]:
+                    user, repo = (repository["owner"]["login"],
+                                  repository["name"])
+                    if f"{user}/{repo}".lower() not in seen:
+                        seen.add(f"{user}/{repo}".lower())
+                        yield user, repo
+                if not result["pageInfo"].get("hasNextPage", True):
+                    break
+                variables["cursor"] = result["pageInfo"]["nextCursor"]
+                if not variables["cursor"]:
+                    break
+
+    def _for_repo(self, user: str, repo: str, subcommand: str) -> "Hubmail":
+        """Returns a Hubmail exporting the issues or pull requests of one
+        repository, sharing the session, cache, rate limits and downloaded
+        images of this one"""
+        arguments = argparse.Namespace(**{
+            **vars(self.arguments),
+            "subcommand": subcommand, "user": user, "repo": repo,
+            "output": None, "cache": None, "resume": False, "trace": None,
+        })
+        hubmail = Hubmail(arguments)
+        hubmail.token = self.token
+        hubmail.session = self.session
+        hubmail.cache = self.cache
+        hubmail.rate_limiter = self.rate_limiter
+        hubmail.batcher = self.batcher
+        hubmail.thread_pages = self.thread_pages
+        hubmail.comment_pages = self.comment_pages
+        hubmail.attachments = self.attachments
+        hubmail.renderer = self.renderer
+        hubmail.stats = self.stats
+        hubmail.state = self.state
+        return hubmail
+
+    async def _format_repos(self) -> AsyncIterator[Message]:
+        """Exports up to self.repo_jobs repositories at once, yielding each
+        message as soon as it is formatted"""
+        # Messages, an exception raised by an export, or None once all
+        # repositories are exported; the queue is bounded so that exports
+        # wait for the output to catch up
+        queue: "asyncio.Queue[Union[Message, BaseException, None]]" = (
+            asyncio.Queue(maxsize=self.queue_size))
+        semaphore = asyncio.Semaphore(self.repo_jobs)
+
+        async def export(user: str, repo: str) -> None:
+            try:
+                for subcommand in self.repo_subcommands:
+                    hubmail = self._for_repo(user, repo, subcommand)
+                    async with _aclosing(
+                            hubmail._iter_messages()) as messages:
+                        async for message in messages:
+                            await queue.put(message)
+                    hubmail._save_state()
+            finally:
+                semaphore.release()
+
+        async def export_all() -> None:
+            tasks: "List[asyncio.Future[None]]" = []
+            try:
+                async for user, repo in self._get_repos():
+                    await semaphore.acquire()
+                    tasks.append(asyncio.ensure_future(export(user, repo)))
+                    # Stop early if an export failed
+                    for task in tasks:
+                        if task.done() and task.exception():
+                            await task
+                await asyncio.gather(*tasks)
+            except asyncio.CancelledError:
+                for task in tasks:
+                    task.cancel()
+                raise
+            except Exception as e:
+                for task in tasks:
+                    task.cancel()
+                await queue.put(e)
+            else:
+                await queue.put(None)
+
+        producer = asyncio.ensure_future(export_all())
+        try:
+            while True:
+                item = await queue.get()
+                if item is None:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            producer.cancel()
+
+    def _iter_messages(self) -> AsyncIterator[Message]:
+        if self.type == "issue":
+            return self._format_numbered_issues(self.user, self.repo)
+        elif self.type == "pull":
+            return self._format_numbered_pulls(self.user, self.repo)
+        elif self.type == "issues":
+            return self._format_issues(self.user, self.repo)
+        elif self.type == "pulls":
+            return self._format_pulls(self.user, self.repo)
+        elif self.type == "repos":
+            return self._format_repos()
+        else:
+            raise ValueError(f"Subcommand {self.type} not yet implemented")
+
+    def _load_checkpoint(self) -> None:
+        """Restores the progress saved by an interrupted export, raising
+        ValueError if there is none"""
+        if not self.checkpoint or not self.output:
+            raise ValueError("--resume requires an output file (-o)")
+        progress = self.checkpoint.load()
+        if progress is None:
+            raise ValueError(
+                f"No checkpoint found at {self.checkpoint.filename}")
+        self.resume_position = progress["position"]
+        self.cursor = progress["cursor"]
+        self.total_threads = progress["threads"]
+        self.resume_skip = progress["skip"]
+        self.high_water = progress["high_water"]
+
+    def _save_state(self) -> None:
+        """Records the time of the latest update exported, if a state file
+        was given"""
+        if self.state and self.high_water:
+            self.state.set(self._state_key(), self.high_water)
+            self.state.save()
+
+    async def messages(self) -> AsyncIterator[Message]:
+        """Exports the threads to export, yielding each message as soon as
+        it is formatted
+
+        Formatting stops while messages are not consumed, once
+        self.queue_size messages are buffered for each thread or repository
+        formatted ahead of the one being yielded.
+        """
+        if not self.token:
+            raise ValueError("No API token given")
+        if self.render_jobs > 0:
+            self.renderer = ProcessPoolExecutor(self.render_jobs)
+        try:
+            async with create_session(self.connections,
+                                      self.timeout) as self.session:
+                try:
+                    async with _aclosing(self._iter_messages()) as messages:
+                        async for message in messages:
+                            yield message
+                finally:
+                    # Stop requests that were made ahead of the messages
+                    # consumed, e.g. if the consumer stopped early
+                    self.batcher.cancel()
+                    self.attachments.cancel()
+        finally:
+            if self.renderer:
+                self.renderer.shutdown()
+            if self.cache:
+                self.cache.close()
 
     async def main(self) -> None:
-        self.token = os.getenv("HUBMAIL_TOKEN")
         if not self.token:
             fatal("No API token found. Have you set the HUBMAIL_TOKEN " +
                    "environment variable?")
 
-        async with aiohttp.ClientSession() as self.session:
-            if self.type == "issue":
-                assert self.number is not None
-                print(await self.format_issue(
-                    self.user, self.repo, self.number))
-            elif self.type == "pull":
-                assert self.number is not None
-                print(await self.format_pull(
-                    self.user, self.repo, self.number))
-            elif self.type == "issues":
-                print(await self.format_issues(self.user, self.repo))
-            elif self.type == "pulls":
-                print(await self.format_pulls(self.user, self.repo))
-            else:
-                fatal(f"Subcommand {self.type} not yet implemented")
+        if self.output_format != "mbox" and not self.output:
+            fatal(f"--output-format {self.output_format} requires an output "
+                  "directory (-o)")
+        if self.resume:
+            try:
+                self._load_checkpoint()
+            except ValueError as e:
+                fatal(f"hubmail: {e}")
+
+        try:
+            with open_output(self.output, self.output_format,
+                             self.shard_size) as self.writer:
+                if self.resume:
+                    # Discard anything written after the last completed thread
+                    self.writer.truncate(self.resume_position)
+                async for message in self.messages():
+                    with self._timer("write", bytes=len(message.text)):
+                        self.writer.write(message)
+            self._save_state()
+            if self.checkpoint:
+                self.checkpoint.remove()
+        except (aiohttp.ClientError, TransientError, QueryTimeoutError,
+                asyncio.TimeoutError) as e:
+            # Raised once retries are exhausted (see hubmail.transport)
+            fatal(f"hubmail: {str(e) or type(e).__name__}")
+        finally:
+            if self.cache:
+                self.cache.close()
+            if self.stats:
+                if self.arguments.stats:
+                    print(self.stats.summary(), file=sys.stderr)
+                self.stats.close()
+
+async def export(config: Config) -> AsyncIterator[Message]:
+    """Exports the issues or pull requests described by config, yielding
+    each message as soon as it is formatted (see Hubmail.messages)
+
+    The state file given by config.state, if any, is updated once all
+    messages have been yielded.
+    """
+    hubmail = Hubmail(config)
+    try:
+        async for message in hubmail.messages():
+            yield message
+        hubmail._save_state()
+    finally:
+        if hubmail.stats:
+            hubmail.stats.close()
+
+@asynccontextmanager
+async def _aclosing(
+    iterator: AsyncIterator[R]
+) -> AsyncIterator[AsyncIterator[R]]:
+    """Closes an async generator once done with it, even if it was not
+    exhausted (like contextlib.aclosing, which needs Python 3.10), rather
+    than leaving it to be closed by the event loop at some later point, when
+    the session it uses may be closed"""
+    try:
+        yield iterator
+    finally:
+        aclose = getattr(iterator, "aclose", None)
+        if aclose:
+            await aclose()
+
+def _uncached(result: Any) -> Any:
+    """Returns a query result without the duration of the request, which
+    does not apply to later uses of a cached result"""
+    return {key: value for key, value in result.items() if key != "elapsed"}
+
+def _cached(variables: QueryVariables) -> Dict[str, Any]:
+    """Returns the variables that identify a cached query result: all but
+    the page sizes, which adapt to the server and change between runs
+
+    A page of any size starts at the same cursor, and the pages after it are
+    requested from its own end cursor, so a cached page can stand in for a
+    page of another size (the excess nodes of a page larger than needed are
+    dropped).
+    """
+    return {name: value for name, value in variables.items()
+            if name not in ("numThreads", "numComments")}
+
+def _name_and_address(actor: Optional[Actor]) -> Tuple[str, str]:
+    """Returns the name and email address to send a message from actor"""
+    actor = actor or NULL_ACTOR
+    return (actor.get("name") or actor.get("login") or "",
+            actor.get("email") or actor.get("emailOrNull") or "")
+
+class _Prefetch:
+    """Formats messages in a task ahead of their consumer, buffering up to
+    maxsize of them
+
+    Iterating over a _Prefetch yields the messages in order, and raises any
+    exception raised while formatting them.
+    """
+    def __init__(self, messages: AsyncIterator[Message],
+                 maxsize: int) -> None:
+        # Messages, an exception, or None once all messages are formatted
+        self.queue: "asyncio.Queue[Union[Message, BaseException, None]]" = (
+            asyncio.Queue(maxsize=maxsize))
+        self.task = asyncio.ensure_future(self._run(messages))
+
+    async def _run(self, messages: AsyncIterator[Message]) -> None:
+        try:
+            # Closed here if the task is cancelled, while the session it uses
+            # is still open
+            async with _aclosing(messages):
+                async for message in messages:
+                    await self.queue.put(message)
+        except Exception as e:
+            await self.queue.put(e)
+        else:
+            await self.queue.put(None)
+
+    async def __aiter__(self) -> AsyncIterator[Message]:
+        while True:
+            item = await self.queue.get()
+            if item is None:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+
+    def cancel(self) -> None:
+        self.task.cancel()
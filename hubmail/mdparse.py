@@ -1,23 +1,39 @@
 # This file is part of hubmail.
 # SPDX-License-Identifier: LGPL-2.1-or-later
 
-import json
+import hashlib
 
-from mistletoe import Document
-from mistletoe.ast_renderer import ASTRenderer
-from typing import List, Any
+from typing import Any, Dict, Iterator, List, Tuple
+
+# Image URLs of recently parsed documents, keyed by a digest of the document
+# (so that the documents themselves are not kept in memory), e.g. for bodies
+# that are rendered again when an export is resumed or repeated in the same
+# process
+MAX_CACHED_DOCUMENTS = 4096
+_cache: Dict[bytes, Tuple[str, ...]] = {}
 
 def get_image_urls(text: str) -> List[str]:
     """Gets image URLs from a Markdown document"""
-    with ASTRenderer() as renderer:
-        ast = json.loads(renderer.render(Document(text)))
-    return _get_image_urls(ast)
-
-def _get_image_urls(ast: Any) -> List[str]:
-    """Returns an array of URLs given a mistletoe AST"""
-    if ast["type"] == "Image" and ast["src"]:
-        return [ast["src"]]
-    elif "children" in ast:
-        return sum([_get_image_urls(child) for child in ast["children"]], [])
-    else:
+    if "![" not in text:
+        # Every image starts with "![", so there is nothing to parse (and
+        # mistletoe, which takes long to import, is not needed)
         return []
+    key = hashlib.blake2b(text.encode(errors="surrogatepass"),
+                          digest_size=16).digest()
+    urls = _cache.get(key)
+    if urls is None:
+        from mistletoe import Document
+        urls = tuple(_get_image_urls(Document(text)))
+        if len(_cache) >= MAX_CACHED_DOCUMENTS:
+            # Forget the document parsed first
+            del _cache[next(iter(_cache))]
+        _cache[key] = urls
+    return list(urls)
+
+def _get_image_urls(token: Any) -> Iterator[str]:
+    """Yields the URLs of the images in a mistletoe token, in order"""
+    if type(token).__name__ == "Image" and token.src:
+        yield token.src
+    elif token.children is not None:
+        for child in token.children:
+            yield from _get_image_urls(child)
@@ -0,0 +1,62 @@
+# This file is part of hubmail.
+# SPDX-License-Identifier: LGPL-2.1-or-later
+
+from typing import List, NamedTuple, Optional, Tuple
+
+# The owner and name of the repository of a thread, "issues" or "pull", and
+# the number of the thread, as in the Message-IDs of its messages (e.g.
+# <user/repo/issues/1/c123@github.com>)
+ThreadInfo = Tuple[str, str, str, str]
+
+class Message(NamedTuple):
+    """A formatted message, along with the identifiers that thread it
+
+    text is the message as written to an mbox, starting with its "From "
+    line; headers and body are taken from it when accessed.
+    """
+    text: str
+    user: str
+    repo: str
+    # "issues" or "pull"
+    thread_type: str
+    number: int
+    message_id: str
+    # The Message-ID of the message it replies to (the first message of the
+    # thread, or a review or comment on a line of a pull request), or None
+    # for the first message itself
+    in_reply_to: Optional[str]
+
+    @classmethod
+    def create(cls, text: str, thread_info: ThreadInfo, message_id: str,
+               in_reply_to: Optional[str] = None) -> "Message":
+        user, repo, thread_type, number = thread_info
+        return cls(text, user, repo, thread_type, int(number), message_id,
+                   in_reply_to or None)
+
+    @property
+    def thread_id(self) -> str:
+        """The Message-ID of the first message of the thread"""
+        return (f"<{self.user}/{self.repo}/{self.thread_type}/{self.number}"
+                "@github.com>")
+
+    @property
+    def headers(self) -> List[Tuple[str, str]]:
+        """The names and values of the headers, in order, with folded values
+        unfolded (non-ASCII text stays in RFC 2047 encoded words)"""
+        block = self.text.partition("\n\n")[0]
+        if block.startswith("From "):
+            block = block.partition("\n")[2]
+        headers: List[Tuple[str, str]] = []
+        for line in block.split("\n"):
+            if line[:1] in (" ", "\t") and headers:
+                name, value = headers[-1]
+                headers[-1] = (name, value + line)
+            elif line:
+                name, _, value = line.partition(":")
+                headers.append((name, value.lstrip()))
+        return headers
+
+    @property
+    def body(self) -> bytes:
+        """The body encoded as it is written, i.e. in UTF-8"""
+        return self.text.partition("\n\n")[2].encode()
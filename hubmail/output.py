@@ -0,0 +1,242 @@
+# This file is part of hubmail.
+# SPDX-License-Identifier: LGPL-2.1-or-later
+
+import os
+import sys
+import json
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, Future
+from contextlib import contextmanager
+
+from typing import Optional, Iterator, List, TextIO, Dict, Any, Set
+from hubmail.message import Message
+
+def _terminated(message: str) -> str:
+    return message if message.endswith("\n") else message + "\n"
+
+class Writer:
+    """A destination for formatted messages
+
+    tell() returns a position that can be saved in a checkpoint, and
+    truncate() discards everything written after such a position.
+    """
+    def write(self, message: Message) -> None:
+        raise NotImplementedError
+
+    def tell(self) -> Any:
+        return None
+
+    def truncate(self, position: Any) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+class MboxWriter(Writer):
+    """Writes messages to a file in mbox format as soon as they are formatted
+    """
+    def __init__(self, file: TextIO) -> None:
+        self.file = file
+
+    def write(self, message: Message) -> None:
+        # Each message is followed by an empty line, so that the "From " line
+        # of the next message starts a new paragraph (RFC 4155)
+        self.file.write(_terminated(message.text))
+        self.file.write("\n")
+        self.file.flush()
+
+    def tell(self) -> int:
+        return self.file.tell()
+
+    def truncate(self, position: Any) -> None:
+        self.file.truncate(position)
+
+class MaildirWriter(Writer):
+    """Writes each message to its own file in a Maildir, named after its
+    Message-ID
+
+    Each file is written to tmp/ and then renamed into new/, so mail clients
+    never see partial messages. Messages already in the Maildir (in new/ or
+    cur/) are not written again, and the files are written by a pool of
+    threads.
+
+    As files are named after the Message-ID alone, a comment edited after
+    it was written to the Maildir is not written again: the Maildir keeps
+    the first version exported.
+    """
+    def __init__(self, directory: str, jobs: int = 4) -> None:
+        self.directory = directory
+        for subdirectory in ("tmp", "new", "cur"):
+            os.makedirs(os.path.join(directory, subdirectory), exist_ok=True)
+        # Mail clients move messages to cur/ and append ":2,FLAGS"
+        self.existing: Set[str] = set(
+            name.split(":", 1)[0]
+            for subdirectory in ("new", "cur")
+            for name in os.listdir(os.path.join(directory, subdirectory)))
+        self.executor = ThreadPoolExecutor(max_workers=jobs)
+        self.pending: List["Future[None]"] = []
+
+    def write(self, message: Message) -> None:
+        key = message.message_id
+        name = f"{hashlib.sha1(key.encode()).hexdigest()}.hubmail"
+        if name in self.existing:
+            return
+        self.existing.add(name)
+        # Maildir files have no "From " line
+        text = message.text
+        if text.startswith("From "):
+            text = text.split("\n", 1)[1]
+        self._check_pending()
+        self.pending.append(self.executor.submit(
+            self._write_file, name, _terminated(text).encode()))
+
+    def _write_file(self, name: str, data: bytes) -> None:
+        tmp_path = os.path.join(self.directory, "tmp", name)
+        with open(tmp_path, "wb") as file:
+            file.write(data)
+        os.replace(tmp_path, os.path.join(self.directory, "new", name))
+
+    def _check_pending(self) -> None:
+        # Raise errors from finished writes and forget about them
+        pending = []
+        for future in self.pending:
+            if future.done():
+                future.result()
+            else:
+                pending.append(future)
+        self.pending = pending
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=True)
+        self._check_pending()
+
+class ShardedMboxWriter(Writer):
+    """Writes messages to mbox files in a directory, one per shard_size
+    threads, so that incremental exports only append to the files of the
+    threads that changed
+
+    Shards are named after the repository, the subcommand and the number of
+    the first thread they can contain.
+
+    Before a thread is first written to a shard, the size of the shard (or
+    null if it is new) is appended to a journal in the directory, and tell()
+    returns the size of the journal. truncate() restores the shards written
+    after a position to their size in the journal, so that a checkpoint
+    stays the same size however many shards an export writes.
+    """
+    def __init__(self, directory: str, shard_size: int = 1) -> None:
+        self.directory = directory
+        self.shard_size = max(shard_size, 1)
+        os.makedirs(directory, exist_ok=True)
+        self.files: Dict[str, TextIO] = {}
+        self.journal_path = os.path.join(directory, ".hubmail-journal")
+        self.journal: Optional[TextIO] = None
+        # Shards written since the last call to tell()
+        self.journaled: Set[str] = set()
+
+    def _shard(self, message: Message) -> str:
+        first = ((message.number - 1) // self.shard_size * self.shard_size
+                 + 1)
+        return (f"{message.user}_{message.repo}_{message.thread_type}_"
+                f"{first}.mbox")
+
+    def _file(self, name: str) -> TextIO:
+        if name not in self.files:
+            if len(self.files) >= 64:
+                # Threads arrive in order, so old shards are rarely needed
+                # again; keep the number of open files bounded
+                oldest = next(iter(self.files))
+                self.files.pop(oldest).close()
+            self.files[name] = open(os.path.join(self.directory, name), "a",
+                                    encoding="utf-8")
+        return self.files[name]
+
+    def _journal(self) -> TextIO:
+        if self.journal is None:
+            # Unless truncate() reopened it to resume an export, the journal
+            # of an earlier export is no longer needed
+            self.journal = open(self.journal_path, "w", encoding="utf-8")
+        return self.journal
+
+    def _record_size(self, name: str) -> None:
+        size: Optional[int]
+        if name in self.files:
+            size = self.files[name].tell()
+        else:
+            try:
+                size = os.path.getsize(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                size = None
+        journal = self._journal()
+        journal.write(json.dumps([name, size]) + "\n")
+        journal.flush()
+
+    def write(self, message: Message) -> None:
+        name = self._shard(message)
+        if name not in self.journaled:
+            self._record_size(name)
+            self.journaled.add(name)
+        file = self._file(name)
+        file.write(_terminated(message.text))
+        file.write("\n")
+        file.flush()
+
+    def tell(self) -> int:
+        self.journaled.clear()
+        return self._journal().tell()
+
+    def truncate(self, position: Any) -> None:
+        sizes: Dict[str, Optional[int]] = {}
+        with open(self.journal_path, "r+", encoding="utf-8") as journal:
+            journal.seek(position)
+            for line in journal:
+                # A line cut short was written just before the export was
+                # interrupted, and its shard was not written to
+                if line.endswith("\n"):
+                    name, size = json.loads(line)
+                    sizes.setdefault(name, size)
+            journal.truncate(position)
+        for name, size in sizes.items():
+            path = os.path.join(self.directory, name)
+            if size is None:
+                if os.path.exists(path):
+                    os.remove(path)
+            else:
+                os.truncate(path, size)
+        self.journal = open(self.journal_path, "a", encoding="utf-8")
+
+    def close(self) -> None:
+        for file in self.files.values():
+            file.close()
+        if self.journal:
+            self.journal.close()
+
+@contextmanager
+def open_output(filename: Optional[str], output_format: str = "mbox",
+                shard_size: int = 1) -> Iterator[Writer]:
+    """Opens a writer for the given output format: an mbox appending to a
+    file (or to stdout if filename is None or "-"), a Maildir, or a directory
+    of sharded mbox files
+    """
+    writer: Writer
+    if output_format == "maildir":
+        assert filename, "Maildir output requires a directory"
+        writer = MaildirWriter(filename)
+    elif output_format == "sharded":
+        assert filename, "Sharded output requires a directory"
+        writer = ShardedMboxWriter(filename, shard_size)
+    elif filename is None or filename == "-":
+        yield MboxWriter(sys.stdout)
+        return
+    else:
+        with open(filename, "a", encoding="utf-8") as file:
+            yield MboxWriter(file)
+        return
+    try:
+        yield writer
+    finally:
+        writer.close()
+
+def join_messages(messages: List[str]) -> str:
+    """Joins messages into a single string in mbox format"""
+    return "".join(_terminated(message) + "\n" for message in messages)
@@ -0,0 +1,62 @@
+# This file is part of hubmail.
+# SPDX-License-Identifier: LGPL-2.1-or-later
+
+from typing import Optional
+
+# GitHub allows up to 100 nodes per page of a connection
+MAX_PAGE_SIZE = 100
+MIN_PAGE_SIZE = 5
+DEFAULT_PAGE_SIZE = 20
+
+# Pages are made larger after responses faster than FAST_RESPONSE seconds
+# that cost at most CHEAP_COST rate limit points, and smaller after responses
+# slower than SLOW_RESPONSE seconds (GitHub gives up on queries after 10
+# seconds)
+FAST_RESPONSE = 2.0
+SLOW_RESPONSE = 6.0
+CHEAP_COST = 5
+
+class QueryTimeoutError(Exception):
+    """Raised when GitHub gives up on a query, e.g. with a 502 response"""
+
+class PageSize:
+    """The number of nodes to request per page of a connection, adapted to
+    how quickly and cheaply the server returns pages
+
+    The size grows by half after each fast and cheap page, and halves after a
+    slow page or a timeout. After a timeout, it never grows beyond three
+    quarters of the size that timed out. A fixed size does not adapt.
+    """
+    def __init__(self, fixed: Optional[int] = None) -> None:
+        self.fixed = fixed is not None
+        self.size = (min(max(fixed, 1), MAX_PAGE_SIZE) if fixed is not None
+                     else DEFAULT_PAGE_SIZE)
+        # Largest size to grow to
+        self.ceiling = MAX_PAGE_SIZE
+
+    def update(self, tried: int, elapsed: float,
+               cost: Optional[float]) -> None:
+        """Adapts the size after a page requested with size tried took
+        elapsed seconds and cost rate limit points"""
+        if self.fixed or self.size != tried:
+            # Already adapted after another page of the same batch, or
+            # requested at the same time
+            return
+        if elapsed > SLOW_RESPONSE:
+            self.size = max(MIN_PAGE_SIZE, self.size // 2)
+        elif elapsed < FAST_RESPONSE and (cost or 0) <= CHEAP_COST:
+            self.size = min(self.ceiling, self.size * 3 // 2)
+
+    def shrink(self, tried: int) -> bool:
+        """Halves the size after a page of tried nodes timed out, returning
+        whether a smaller page can be tried"""
+        # Stay well below the size that timed out, so that a size close to
+        # the server's limit is not tried again and again
+        self.ceiling = max(MIN_PAGE_SIZE, min(self.ceiling, tried * 3 // 4))
+        if self.size < tried:
+            # Already shrunk after another page timed out at the same time
+            return True
+        if self.fixed or self.size <= MIN_PAGE_SIZE:
+            return False
+        self.size = max(MIN_PAGE_SIZE, self.size // 2)
+        return True
@@ -0,0 +1,63 @@
+# This file is part of hubmail.
+# SPDX-License-Identifier: LGPL-2.1-or-later
+
+import re
+
+from typing import List, NamedTuple
+
+# The line that starts each commit in the output of git format-patch (lines of
+# a diff start with a space, "+" or "-", so only a commit message could
+# contain another line starting with "From ")
+REGEX_COMMIT = re.compile(rb"^From [0-9a-f]{40,64} ", flags=re.MULTILINE)
+
+class Patch(NamedTuple):
+    # The "From " line, without "From " and the newline
+    unixfrom: str
+    headers: str
+    body: str
+
+class PatchSplitter:
+    """Splits the output of git format-patch into commits as it is
+    downloaded, keeping at most one commit in memory
+
+    The headers and body of each commit are kept separate so that the patch
+    is not mangled (e.g. if it contains CRLF, it is not converted to LF).
+    Anything before the first commit is ignored.
+    """
+    def __init__(self) -> None:
+        # The commit being read (or what precedes the first commit)
+        self.buffer = bytearray()
+        self.in_commit = False
+        # Where to resume searching the buffer for the next commit
+        self.searched = 0
+
+    def feed(self, data: bytes) -> List[Patch]:
+        """Reads the next chunk of the patch, returning the commits that it
+        completes"""
+        self.buffer += data
+        patches: List[Patch] = []
+        while True:
+            match = REGEX_COMMIT.search(self.buffer, self.searched)
+            if match is None:
+                # The last line may be the start of a commit, cut short
+                self.searched = max(self.searched,
+                                    self.buffer.rfind(b"\n") + 1)
+                return patches
+            if self.in_commit:
+                patches.append(self._patch(match.start()))
+            del self.buffer[:match.start()]
+            self.in_commit = True
+            self.searched = 1
+
+    def close(self) -> List[Patch]:
+        """Returns the last commit once the whole patch has been read"""
+        patches = [self._patch(len(self.buffer))] if self.in_commit else []
+        self.buffer = bytearray()
+        self.in_commit = False
+        self.searched = 0
+        return patches
+
+    def _patch(self, end: int) -> Patch:
+        unixfrom, text = self.buffer[len(b"From "):end].decode().split("\n", 1)
+        headers, body = text.split("\n\n", 1)
+        return Patch(unixfrom, headers, body)
@@ -0,0 +1,80 @@
+# This file is part of hubmail.
+# SPDX-License-Identifier: LGPL-2.1-or-later
+
+import re
+
+from typing import Dict, List, Optional
+
+REGEX_DEFINITION = re.compile(r"^(?:query|fragment) (\w+)",
+                              flags=re.MULTILINE)
+REGEX_SPREAD = re.compile(r"\.\.\.\s*(?!on\b)(\w+)")
+# GraphQL tokens, along with comments and insignificant whitespace and commas
+REGEX_TOKEN = re.compile(r"""
+    (?P<string>"(?:\\.|[^"\\])*")
+    | (?P<ignored>\#[^\n]*|[\s,]+)
+    | (?P<word>-?\w+(?:\.\d+)?(?:[eE][+-]?\d+)?)
+    | (?P<punctuator>\.\.\.|.)
+""", flags=re.VERBOSE | re.DOTALL)
+
+def split_definitions(document: str) -> Dict[str, str]:
+    """Returns each operation and fragment of a GraphQL document by name"""
+    matches = list(REGEX_DEFINITION.finditer(document))
+    return {
+        match.group(1):
+        document[match.start():(matches[i + 1].start()
+                                if i + 1 < len(matches) else None)].strip()
+        for i, match in enumerate(matches)
+    }
+
+def minify(document: str) -> str:
+    """Removes comments, commas and whitespace that are not needed to
+    separate tokens"""
+    tokens: List[str] = []
+    previous_word = False
+    for match in REGEX_TOKEN.finditer(document):
+        if match.lastgroup == "ignored":
+            continue
+        is_word = match.lastgroup == "word"
+        if is_word and previous_word:
+            tokens.append(" ")
+        tokens.append(match.group())
+        previous_word = is_word
+    return "".join(tokens)
+
+class Queries:
+    """The operations of the GraphQL document in filename, each of which can
+    be sent on its own: with only the fragments it uses, and minified
+
+    The file is read the first time an operation is used, and documents are
+    built the first time each operation is used and kept for the rest of the
+    run.
+    """
+    def __init__(self, filename: str) -> None:
+        self.filename = filename
+        self._definitions: Optional[Dict[str, str]] = None
+        self.documents: Dict[str, str] = {}
+
+    @property
+    def definitions(self) -> Dict[str, str]:
+        if self._definitions is None:
+            with open(self.filename, "r") as query_file:
+                self._definitions = split_definitions(query_file.read())
+        return self._definitions
+
+    def __getitem__(self, opname: str) -> str:
+        if opname not in self.documents:
+            self.documents[opname] = self.document(
+                self.definitions[opname])
+        return self.documents[opname]
+
+    def document(self, operation: str) -> str:
+        """Returns an operation followed by the fragments it uses, minified"""
+        needed: List[str] = []
+        pending = [operation]
+        while pending:
+            for name in REGEX_SPREAD.findall(pending.pop()):
+                if name not in needed:
+                    needed.append(name)
+                    pending.append(self.definitions[name])
+        return minify("\n".join(
+            [operation] + [self.definitions[name] for name in needed]))
@@ -0,0 +1,126 @@
+# This file is part of hubmail.
+# SPDX-License-Identifier: LGPL-2.1-or-later
+
+import sys
+import asyncio
+from time import time, localtime, strftime
+from urllib.parse import urlparse
+
+from typing import Optional, Dict, Mapping, Any
+from dateutil.parser import isoparse
+
+# Start spreading requests over the time until reset once less than this
+# fraction of the budget is left
+LOW_BUDGET = 0.1
+
+class RateLimit:
+    """Tracks the remaining budget of one GitHub rate limit resource (e.g.
+    "graphql" or "core") and delays requests to stay within it
+    """
+    def __init__(self, resource: str) -> None:
+        self.resource = resource
+        self.limit: Optional[int] = None
+        self.remaining: Optional[int] = None
+        self.reset_at = 0.0
+        self._lock: Optional[asyncio.Lock] = None
+
+    def update(self, limit: Optional[int], remaining: Optional[int],
+               reset_at: Optional[float]) -> None:
+        if limit is not None:
+            self.limit = limit
+        if reset_at is not None and reset_at != self.reset_at:
+            # A new window started; trust the server's count
+            self.reset_at = reset_at
+            self.remaining = remaining
+        elif remaining is not None:
+            # Responses may arrive out of order; keep the lowest count seen
+            self.remaining = (remaining if self.remaining is None
+                              else min(self.remaining, remaining))
+
+    def exhaust(self, reset_at: Optional[float] = None) -> None:
+        """Marks the budget as used up, e.g. after a rate-limited response"""
+        self.remaining = 0
+        self.reset_at = max(self.reset_at, reset_at or time() + 60)
+
+    async def acquire(self, cost: int = 1) -> None:
+        """Waits until a request of the given cost fits in the budget"""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            now = time()
+            if self.remaining is None or now >= self.reset_at:
+                return
+            if self.remaining < cost:
+                print(f"hubmail: {self.resource} rate limit reached; "
+                      f"waiting until "
+                      f"{strftime('%H:%M:%S', localtime(self.reset_at))}",
+                      file=sys.stderr)
+                await asyncio.sleep(self.reset_at - now + 1)
+                self.remaining = None
+                return
+            if self.limit and self.remaining < self.limit * LOW_BUDGET:
+                # Spread what is left of the budget evenly until the reset
+                await asyncio.sleep(
+                    (self.reset_at - now) * cost / self.remaining)
+            self.remaining -= cost
+
+class RateLimiter:
+    """Rate limit budgets for each resource, updated from GraphQL rateLimit
+    objects and REST X-RateLimit-* headers
+    """
+    def __init__(self) -> None:
+        self.limits: Dict[str, RateLimit] = {}
+        # Last known cost of each GraphQL operation
+        self.costs: Dict[str, int] = {}
+        # Resource reported by each host for REST requests
+        self.hosts: Dict[str, str] = {}
+
+    def __getitem__(self, resource: str) -> RateLimit:
+        if resource not in self.limits:
+            self.limits[resource] = RateLimit(resource)
+        return self.limits[resource]
+
+    async def acquire_query(self, opname: str) -> None:
+        await self["graphql"].acquire(self.costs.get(opname, 1))
+
+    def update_from_query(self, opname: str, rate_limit: Any) -> None:
+        if not rate_limit:
+            return
+        self.costs[opname] = rate_limit["cost"]
+        self["graphql"].update(rate_limit["limit"], rate_limit["remaining"],
+                               isoparse(rate_limit["resetAt"]).timestamp())
+
+    def for_url(self, url: str) -> RateLimit:
+        host = urlparse(url).hostname or ""
+        return self[self.hosts.get(host, host)]
+
+    def update_from_headers(self, url: str,
+                            headers: Mapping[str, str]) -> None:
+        if "X-RateLimit-Remaining" not in headers:
+            return
+        host = urlparse(url).hostname or ""
+        self.hosts[host] = headers.get("X-RateLimit-Resource", host)
+        self.for_url(url).update(
+            _int_or_none(headers.get("X-RateLimit-Limit")),
+            _int_or_none(headers.get("X-RateLimit-Remaining")),
+            _int_or_none(headers.get("X-RateLimit-Reset")))
+
+    def reset_time(self, headers: Mapping[str, str]) -> float:
+        """Returns when a rate-limited request may be retried"""
+        retry_after = _int_or_none(headers.get("Retry-After"))
+        if retry_after is not None:
+            return time() + retry_after
+        return _int_or_none(headers.get("X-RateLimit-Reset")) or time() + 60
+
+def is_rate_limited(status: int, headers: Mapping[str, str]) -> bool:
+    """Returns whether a response was rejected because of a (primary or
+    secondary) rate limit"""
+    return status == 429 or status == 403 and (
+        headers.get("X-RateLimit-Remaining") == "0"
+        or "Retry-After" in headers)
+
+def _int_or_none(value: Optional[str]) -> Optional[int]:
+    try:
+        return int(value) if value is not None else None
+    except ValueError:
+        return None
@@ -0,0 +1,196 @@
+# This file is part of hubmail.
+# SPDX-License-Identifier: LGPL-2.1-or-later
+
+"""The CPU-bound parts of formatting a message, which only depend on their
+arguments so that they can run in worker processes
+"""
+
+import re
+import textwrap
+import importlib.util
+import time
+import email.policy
+from email.message import EmailMessage
+from email.headerregistry import Address
+from email.utils import format_datetime
+from datetime import datetime
+from functools import lru_cache
+
+from typing import Optional, List, Tuple, Callable
+from hubmail.attachments import Attachment
+from hubmail.stats import stage
+
+get_image_urls: Optional[Callable[[str], List[str]]]
+if importlib.util.find_spec("mistletoe") is not None:
+    # mistletoe itself is only imported by the first message linking images
+    from hubmail.mdparse import get_image_urls
+else:
+    # mistletoe is optional; without it, linked images are not attached
+    get_image_urls = None
+
+REGEX_FROM = re.compile(r"^From", flags=re.MULTILINE)
+# Header values that EmailMessage writes out unchanged when they fit on one
+# line: printable ASCII words separated by single spaces
+REGEX_PLAIN_HEADER = re.compile(r"[!-~]+(?: [!-~]+)*")
+
+# RFC 5322 limit on the length of a line, used when text is not wrapped
+MAX_LINE_LENGTH = 998
+
+@lru_cache(maxsize=None)
+def get_policy(
+        wrap: Optional[int]) -> "email.policy.EmailPolicy[EmailMessage]":
+    return email.policy.default.clone(
+        max_line_length = wrap or MAX_LINE_LENGTH,
+        raise_on_defect = True,
+    )
+
+def prepare_body(body: str, wrap: Optional[int]) -> Tuple[str, List[str]]:
+    """Wraps and escapes the body of a message, returning it along with the
+    URLs of the images it links"""
+    body = body.replace("\r\n", "\n")
+
+    cols = wrap or 0
+    if cols > 0:
+        with stage("render.wrap"):
+            body = "\n".join(
+                textwrap.fill(
+                    line, cols, expand_tabs=False, replace_whitespace=False,
+                    break_long_words=False, break_on_hyphens=False,
+                    subsequent_indent=(
+                        "> " if line.startswith("> ")
+                        else ">" if line.startswith(">")
+                        else ""))
+                for line in body.splitlines())
+
+    # Replace "From" at the beginning of a line with ">From"
+    # (see https://www.jwz.org/doc/content-length.html)
+    body = REGEX_FROM.sub(r">From", body)
+
+    image_urls = []
+    if get_image_urls is not None:
+        with stage("render.markdown"):
+            image_urls = get_image_urls(body)
+    return body, image_urls
+
+def render_email(wrap: Optional[int], name: str, address: str,
+                 timestamp: datetime, subject: str, body: str,
+                 message_id: str, in_reply_to: str, references: str,
+                 html: Optional[str], attachments: List[Attachment]) -> str:
+    """Builds a message from a body returned by prepare_body"""
+    if not html and not attachments:
+        with stage("render.plain"):
+            message = _render_plain(wrap, name, address, timestamp, subject,
+                                    body, message_id, in_reply_to, references)
+        if message is not None:
+            return message
+    with stage("render.mime"):
+        return _render_mime(wrap, name, address, timestamp, subject, body,
+                            message_id, in_reply_to, references, html,
+                            attachments)
+
+def _sender(name: str, address: str) -> Address:
+    try:
+        return Address(name, addr_spec=address)
+    except IndexError:
+        return Address(name)
+
+def _render_mime(wrap: Optional[int], name: str, address: str,
+                 timestamp: datetime, subject: str, body: str,
+                 message_id: str, in_reply_to: str, references: str,
+                 html: Optional[str], attachments: List[Attachment]) -> str:
+    policy = get_policy(wrap)
+    msg = EmailMessage(policy=policy)
+    msg.set_content(body)
+
+    if html:
+        msg.add_alternative(html, subtype="html")
+
+    for attachment in attachments:
+        msg.add_attachment(
+            attachment.data, maintype=attachment.maintype,
+            subtype=attachment.subtype, filename=attachment.filename
+        )
+
+    msg["From"] = _sender(name, address)
+    msg["Date"] = timestamp
+    msg["Subject"] = subject
+    if message_id:
+        msg["Message-ID"] = message_id
+    if in_reply_to:
+        msg["In-Reply-To"] = in_reply_to
+
+    if references and in_reply_to:
+        msg["References"] = f"{references} {in_reply_to}"
+    elif references:
+        msg["References"] = references
+    elif in_reply_to:
+        msg["References"] = in_reply_to
+
+    # For some reason as_string does not include the unixfrom line
+    # and as_bytes uses the quoted-printable encoding despite purportedly
+    # supporting native Unicode.
+    return msg.as_bytes(policy=policy, unixfrom=True).decode()
+
+def _render_plain(wrap: Optional[int], name: str, address: str,
+                  timestamp: datetime, subject: str, body: str,
+                  message_id: str, in_reply_to: str,
+                  references: str) -> Optional[str]:
+    """Serializes a text/plain message without building an EmailMessage,
+    returning exactly what _render_mime would, or None if the message needs
+    header folding or encoding (or a body encoding other than 7bit or 8bit)
+    """
+    max_line_length = wrap or MAX_LINE_LENGTH
+    headers = [("From", str(_sender(name, address))),
+               ("Date", format_datetime(timestamp)), ("Subject", subject)]
+    if message_id:
+        headers.append(("Message-ID", message_id))
+    if in_reply_to:
+        headers.append(("In-Reply-To", in_reply_to))
+    if references and in_reply_to:
+        headers.append(("References", f"{references} {in_reply_to}"))
+    elif references or in_reply_to:
+        headers.append(("References", references or in_reply_to))
+
+    lines = []
+    for header, value in headers:
+        line = f"{header}: {value}"
+        if (len(line) > max_line_length or "=?" in value
+                or not REGEX_PLAIN_HEADER.fullmatch(value)):
+            return None
+        lines.append(line)
+
+    # Like email.contentmanager, which splits the encoded body into lines
+    # and only leaves it unencoded if every line fits
+    try:
+        body_lines = body.encode().splitlines()
+    except UnicodeEncodeError:
+        return None
+    if max((len(line) for line in body_lines), default=0) > max_line_length:
+        return None
+    payload = b"\n".join(body_lines).decode() + "\n"
+
+    return "\n".join([
+        "From nobody " + time.ctime(time.time()),
+        'Content-Type: text/plain; charset="utf-8"',
+        "Content-Transfer-Encoding: " + ("7bit" if payload.isascii()
+                                         else "8bit"),
+        "MIME-Version: 1.0",
+        *lines,
+        "",
+        payload,
+    ])
+
+def format_email(wrap: Optional[int], name: str, address: str,
+                 timestamp: datetime, subject: str, body: str,
+                 message_id: str, in_reply_to: str, references: str,
+                 html: Optional[str]) -> Tuple[Optional[str], str, List[str]]:
+    """Prepares and renders a message in one step unless it links images
+
+    Returns the message, or None along with the prepared body and the image
+    URLs if the images need to be downloaded and passed to render_email.
+    """
+    body, image_urls = prepare_body(body, wrap)
+    if image_urls:
+        return None, body, image_urls
+    return render_email(wrap, name, address, timestamp, subject, body,
+                        message_id, in_reply_to, references, html, []), body, []
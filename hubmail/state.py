@@ -0,0 +1,71 @@
+# This file is part of hubmail.
+# SPDX-License-Identifier: LGPL-2.1-or-later
+
+import os
+import json
+
+from typing import Optional, Dict, Any
+
+def _write_json(filename: str, data: Any) -> None:
+    # Write to a temporary file first so that an interrupted run does not
+    # leave a truncated file behind
+    tmp_filename = f"{filename}.tmp"
+    with open(tmp_filename, "w") as file:
+        json.dump(data, file, indent=2, sort_keys=True)
+        file.write("\n")
+    os.replace(tmp_filename, filename)
+
+class SyncState:
+    """High-water marks for incremental exports, stored in a JSON file that
+    maps "USER/REPO/SUBCOMMAND" to the latest updatedAt timestamp exported
+    """
+    def __init__(self, filename: str) -> None:
+        self.filename = filename
+        self.marks: Dict[str, str] = {}
+        try:
+            with open(filename, "r") as file:
+                self.marks = json.load(file)
+        except FileNotFoundError:
+            pass
+
+    def get(self, key: str) -> Optional[str]:
+        return self.marks.get(key)
+
+    def set(self, key: str, timestamp: str) -> None:
+        self.marks[key] = timestamp
+
+    def save(self) -> None:
+        _write_json(self.filename, self.marks)
+
+class Checkpoint:
+    """A journal of the progress of an export to a file, saved after each
+    thread is written so that an interrupted export can be resumed
+
+    The journal records the cursor of the page containing the next thread to
+    export, the number of threads before that page and the number of threads
+    of that page already written, along with the position of the output
+    writer (e.g. the size of an mbox file) at that point.
+    """
+    def __init__(self, output: str, key: str) -> None:
+        self.filename = f"{output}.checkpoint"
+        self.key = key
+
+    def load(self) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self.filename, "r") as file:
+                progress: Dict[str, Any] = json.load(file)
+        except FileNotFoundError:
+            return None
+        if progress.get("key") != self.key:
+            raise ValueError(f"{self.filename} is a checkpoint of "
+                             f"{progress.get('key')}, not {self.key}")
+        return progress
+
+    def save(self, progress: Dict[str, Any]) -> None:
+        _write_json(self.filename, {"key": self.key, **progress})
+
+    def remove(self) -> None:
+        try:
+            os.remove(self.filename)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,154 @@
+# This file is part of hubmail.
+# SPDX-License-Identifier: LGPL-2.1-or-later
+
+import json
+import math
+from time import perf_counter, time
+from contextlib import contextmanager, nullcontext
+
+from typing import (Any, Callable, ContextManager, Dict, Iterator, List,
+                    Optional, Tuple, TypeVar)
+
+R = TypeVar("R")
+
+# Latencies are counted in buckets of exponentially growing width: under
+# 0.1 ms, under 0.2 ms, under 0.4 ms, and so on up to about 14 minutes
+FIRST_BUCKET = 1e-4
+BUCKETS = 24
+
+# Fields of events that are summed over each stage (others are only traced)
+SUMMED_FIELDS = ("bytes", "cost")
+
+class Histogram:
+    """Counts of latencies in buckets of exponentially growing width"""
+    def __init__(self) -> None:
+        self.buckets = [0] * BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds: float) -> None:
+        bucket = (math.frexp(seconds / FIRST_BUCKET)[1]
+                  if seconds >= FIRST_BUCKET else 0)
+        self.buckets[min(bucket, BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, fraction: float) -> float:
+        """Returns an estimate of the latency under which the given fraction
+        of latencies fall, assuming latencies are spread evenly within each
+        bucket"""
+        rank = fraction * self.count
+        seen = 0
+        for bucket, count in enumerate(self.buckets):
+            if count and seen + count >= rank:
+                lower = FIRST_BUCKET * 2 ** (bucket - 1) if bucket else 0.0
+                upper = min(FIRST_BUCKET * 2 ** bucket, self.max)
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return self.max
+
+class Stats:
+    """Latencies and totals of each stage of an export (GraphQL queries,
+    downloads, rendering, writing), along with cache hit rates
+
+    Each event is also written to the file trace (if given) as a line of
+    JSON, with the time it started, its stage, how long it took, and the
+    fields recorded with it.
+    """
+    def __init__(self, trace: Optional[str] = None) -> None:
+        self.trace = open(trace, "w") if trace else None
+        self.latencies: Dict[str, Histogram] = {}
+        # Sums of SUMMED_FIELDS over the events of each stage
+        self.totals: Dict[str, Dict[str, float]] = {}
+        # Hits and misses of each cache
+        self.caches: Dict[str, List[int]] = {}
+
+    def close(self) -> None:
+        if self.trace:
+            self.trace.close()
+
+    @contextmanager
+    def timer(self, stage: str, **fields: Any) -> Iterator[Dict[str, Any]]:
+        """Times the enclosed code as an event of stage, recorded with the
+        fields given and those added to the dict yielded"""
+        start = perf_counter()
+        try:
+            yield fields
+        except BaseException as e:
+            fields["error"] = type(e).__name__
+            raise
+        finally:
+            self.record(stage, perf_counter() - start, **fields)
+
+    def record(self, stage: str, elapsed: float, **fields: Any) -> None:
+        """Records an event of stage that took elapsed seconds"""
+        if stage not in self.latencies:
+            self.latencies[stage] = Histogram()
+            self.totals[stage] = {}
+        self.latencies[stage].add(elapsed)
+        totals = self.totals[stage]
+        for name in SUMMED_FIELDS:
+            if name in fields:
+                totals[name] = totals.get(name, 0) + fields[name]
+        if self.trace:
+            self.trace.write(json.dumps({
+                "time": time() - elapsed, "stage": stage,
+                "elapsed": elapsed, **fields}) + "\n")
+
+    def cache(self, name: str, hit: bool) -> None:
+        """Records a lookup in the cache called name"""
+        counts = self.caches.setdefault(name, [0, 0])
+        counts[0 if hit else 1] += 1
+
+    def summary(self) -> str:
+        lines = ["{:<16}{:>8}{:>10}{:>10}{:>10}{:>10}{:>10}{:>10}  {}".format(
+            "stage", "count", "total s", "mean ms", "p50 ms", "p90 ms",
+            "p99 ms", "max ms", "totals")]
+        for stage, histogram in self.latencies.items():
+            lines.append(
+                "{:<16}{:>8}{:>10.2f}{:>10.2f}{:>10.2f}{:>10.2f}{:>10.2f}"
+                "{:>10.2f}  {}".format(
+                    stage, histogram.count, histogram.total,
+                    histogram.total / histogram.count * 1000,
+                    histogram.percentile(0.5) * 1000,
+                    histogram.percentile(0.9) * 1000,
+                    histogram.percentile(0.99) * 1000,
+                    histogram.max * 1000,
+                    ", ".join(f"{name} {value:,}" for name, value
+                              in self.totals[stage].items())))
+        for name, (hits, misses) in self.caches.items():
+            lines.append(f"{name} cache: {hits} hits, {misses} misses "
+                         f"({hits / (hits + misses):.0%} hit rate)")
+        return "\n".join(lines)
+
+# Time spent in each stage of the current call of time_stages in this process
+_stage_times: Optional[Dict[str, float]] = None
+_NOT_TIMED: ContextManager[None] = nullcontext()
+
+def stage(name: str) -> ContextManager[None]:
+    """Times the enclosed code as part of the current call of time_stages, if
+    any (e.g. in a worker process, where there is no Stats to record to)"""
+    if _stage_times is None:
+        return _NOT_TIMED
+    return _time_stage(_stage_times, name)
+
+@contextmanager
+def _time_stage(times: Dict[str, float], name: str) -> Iterator[None]:
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        times[name] = times.get(name, 0.0) + perf_counter() - start
+
+def time_stages(function: Callable[..., R],
+                *args: Any) -> Tuple[R, Dict[str, float]]:
+    """Calls function, returning its result along with the time spent in each
+    stage of it"""
+    global _stage_times
+    _stage_times = {}
+    try:
+        return function(*args), _stage_times
+    finally:
+        _stage_times = None
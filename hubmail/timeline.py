@@ -0,0 +1,66 @@
+# This file is part of hubmail.
+# SPDX-License-Identifier: LGPL-2.1-or-later
+
+"""The items of the timeline of a thread exported as messages (comments,
+reviews and events), and the text of the messages that are not comments
+"""
+
+from typing import Dict, List, Optional
+
+from hubmail.types import PullRequestReviewComment, TimelineItem
+
+# Types of timeline items fetched for each kind of item that can be exported
+# (see --timeline), in the timelineItems connection of a thread
+TIMELINE_ITEM_TYPES: Dict[str, List[str]] = {
+    "comments": ["ISSUE_COMMENT"],
+    "reviews": ["PULL_REQUEST_REVIEW"],
+    "events": ["CLOSED_EVENT", "REOPENED_EVENT", "MERGED_EVENT"],
+}
+# Types of timeline items that only pull requests have
+PULL_REQUEST_ITEM_TYPES = ("PULL_REQUEST_REVIEW", "MERGED_EVENT")
+
+# The first line of the message of a review in each state; reviews that only
+# comment start with their text, and have no message if they have none
+REVIEW_STATES = {
+    "APPROVED": "Approved these changes.",
+    "CHANGES_REQUESTED": "Requested changes.",
+    "DISMISSED": "Reviewed (review dismissed).",
+}
+
+def item_types(kinds: List[str], pull_request: bool) -> List[str]:
+    """Returns the types of timeline items to fetch for the kinds of items
+    to export from issues or pull requests"""
+    return [item_type for kind in kinds
+            for item_type in TIMELINE_ITEM_TYPES[kind]
+            if pull_request or item_type not in PULL_REQUEST_ITEM_TYPES]
+
+def review_text(review: TimelineItem) -> Optional[str]:
+    """Returns the text of the message of a review, or None if it has none
+    (e.g. the review GitHub creates for a single comment on a line)"""
+    state = REVIEW_STATES.get(review.get("state") or "")
+    body = review.get("body") or ""
+    if state and body:
+        return f"{state}\n\n{body}"
+    return state or body or None
+
+def review_comment_text(comment: PullRequestReviewComment) -> str:
+    """Returns the text of the message of a comment on a line of a pull
+    request: the comment, after the lines it comments on (unless it replies
+    to another comment, which already shows them)"""
+    if comment.get("replyTo"):
+        return comment["body"]
+    quoted = "\n".join("> " + line if line else ">"
+                       for line in comment["diffHunk"].splitlines())
+    return f"In {comment['path']}:\n\n{quoted}\n\n{comment['body']}"
+
+def event_text(event: TimelineItem, pull_request: bool) -> str:
+    """Returns the text of the message of an event"""
+    thread = "pull request" if pull_request else "issue"
+    if event["type"] == "ClosedEvent":
+        return f"Closed this {thread}."
+    if event["type"] == "ReopenedEvent":
+        return f"Reopened this {thread}."
+    if event["type"] == "MergedEvent":
+        commit = (event.get("commit") or {}).get("oid", "")
+        return f"Merged commit {commit} into {event.get('mergeRefName')}."
+    raise ValueError(f"Unknown timeline event {event['type']}")
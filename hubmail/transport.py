@@ -0,0 +1,79 @@
+# This file is part of hubmail.
+# SPDX-License-Identifier: LGPL-2.1-or-later
+
+import sys
+import random
+import asyncio
+
+import aiohttp
+
+# Keep idle connections open for this long, so that the GraphQL endpoint and
+# download hosts are not reconnected to between pages and threads
+KEEPALIVE_TIMEOUT = 60
+# Reuse DNS lookups for this long
+DNS_CACHE_TTL = 300
+MAX_CONNECTIONS = 100
+
+# Responses to retry (502 and 504 from the GraphQL endpoint are timeouts,
+# which are answered with smaller pages; see hubmail.paging)
+RETRY_STATUSES = (500, 502, 503, 504)
+# Exponential backoff with full jitter: the nth retry waits for a random time
+# of up to BACKOFF_BASE * 2**n seconds, at most BACKOFF_CAP seconds
+BACKOFF_BASE = 1.0
+BACKOFF_CAP = 60.0
+# GitHub asks for at least a minute between retries after hitting a secondary
+# rate limit that does not say when to retry
+SECONDARY_RATE_LIMIT_DELAY = 60.0
+
+# Failures after which a request is retried
+TRANSIENT_ERRORS = (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError,
+                    asyncio.TimeoutError)
+
+class TransientError(Exception):
+    """Raised for a response worth retrying, e.g. HTTP 503, after waiting
+    for at least minimum_delay seconds (see Backoff.wait)"""
+    def __init__(self, message: str, minimum_delay: float = 0.0) -> None:
+        super().__init__(message)
+        self.minimum_delay = minimum_delay
+
+def create_session(connections_per_host: int,
+                   timeout: float) -> aiohttp.ClientSession:
+    """Returns a session sharing up to connections_per_host warm connections
+    to each host, giving up on connecting or on waiting for data after
+    timeout seconds"""
+    connector = aiohttp.TCPConnector(
+        limit=MAX_CONNECTIONS, limit_per_host=connections_per_host,
+        keepalive_timeout=KEEPALIVE_TIMEOUT, ttl_dns_cache=DNS_CACHE_TTL)
+    return aiohttp.ClientSession(
+        connector=connector,
+        timeout=aiohttp.ClientTimeout(total=None, connect=timeout,
+                                      sock_read=timeout))
+
+def is_secondary_rate_limit(body: str) -> bool:
+    """Returns whether a 403 response without rate limit headers was
+    rejected because of a secondary rate limit"""
+    return "secondary rate limit" in body
+
+class Backoff:
+    """Waits before each retry of a request, for exponentially longer random
+    times, until retries are exhausted
+    """
+    def __init__(self, retries: int) -> None:
+        self.retries = retries
+        self.attempt = 0
+
+    async def wait(self, error: Exception, minimum: float = 0.0) -> None:
+        """Waits before retrying after error, or raises error if there are no
+        retries left
+
+        A minimum is doubled with each retry, e.g. for secondary rate limits.
+        """
+        if self.attempt >= self.retries:
+            raise error
+        delay = minimum * 2 ** self.attempt + random.uniform(
+            0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** self.attempt))
+        self.attempt += 1
+        print(f"hubmail: {str(error) or type(error).__name__}; retrying in "
+              f"{delay:.1f} s ({self.attempt}/{self.retries})",
+              file=sys.stderr)
+        await asyncio.sleep(delay)
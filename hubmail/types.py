@@ -9,6 +9,11 @@ class QueryVariables(TypedDict, total=False):
     numComments: int
     cursor: Optional[str]
     html: Optional[bool]
+    firstComments: bool
+    lastComments: bool
+    itemTypes: List[str]
+    since: str
+    org: str
 
 class Actor(TypedDict, total=False):
     login: str
@@ -18,6 +23,63 @@ class Actor(TypedDict, total=False):
 
 class PageInfo(TypedDict, total=False):
     nextCursor: str
+    hasNextPage: bool
+
+class Commit(TypedDict, total=False):
+    oid: str
+    committedDate: str
+
+class TimelineItem(TypedDict, total=False):
+    """A comment, review or event, as told by type (its GraphQL type name)
+    """
+    type: str
+    # Node ID of reviews and events
+    id: str
+    # Comments and reviews
+    databaseId: int
+    author: Actor
+    body: str
+    bodyHTML: str
+    createdAt: str
+    updatedAt: str
+    lastEditedAt: Optional[str]
+    # Reviews
+    state: str
+    submittedAt: Optional[str]
+    comments: "PullRequestReviewCommentConnection"
+    # Events
+    actor: Actor
+    # Merges
+    commit: Commit
+    mergeRefName: str
+
+class TimelineItemConnection(TypedDict, total=False):
+    nodes: List[TimelineItem]
+    pageInfo: PageInfo
+
+class PullRequestCommit(TypedDict, total=False):
+    commit: Commit
+
+class PullRequestCommitConnection(TypedDict, total=False):
+    nodes: List[PullRequestCommit]
+    pageInfo: PageInfo
+
+class PullRequestReviewComment(TypedDict, total=False):
+    databaseId: int
+    author: Actor
+    body: str
+    bodyHTML: str
+    createdAt: str
+    updatedAt: str
+    lastEditedAt: Optional[str]
+    path: str
+    diffHunk: str
+    replyTo: Optional[Dict[str, int]]
+
+class PullRequestReviewCommentConnection(TypedDict, total=False):
+    nodes: List[PullRequestReviewComment]
+    totalCount: int
+    pageInfo: PageInfo
 
 class Issue(TypedDict, total=False):
     id: str
@@ -27,6 +89,10 @@ class Issue(TypedDict, total=False):
     body: str
     bodyHTML: str
     createdAt: str
+    updatedAt: str
+    lastEditedAt: Optional[str]
+    timeline: TimelineItemConnection
+    timelineFromEnd: TimelineItemConnection
 
 class PullRequest(TypedDict, total=False):
     id: str
@@ -37,18 +103,19 @@ class PullRequest(TypedDict, total=False):
     body: str
     bodyHTML: str
     createdAt: str
+    updatedAt: str
+    lastEditedAt: Optional[str]
+    timeline: TimelineItemConnection
+    timelineFromEnd: TimelineItemConnection
 
 class IssueOrPullRequestConnection(TypedDict, total=False):
     nodes: List[Union[Issue, PullRequest]]
     pageInfo: PageInfo
 
-class IssueComment(TypedDict, total=False):
-    databaseId: int
-    author: Actor
-    body: str
-    bodyHTML: str
-    createdAt: str
+class Repository(TypedDict, total=False):
+    owner: Actor
+    name: str
 
-class IssueCommentConnection(TypedDict, total=False):
-    nodes: List[IssueComment]
+class RepositoryConnection(TypedDict, total=False):
+    nodes: List[Repository]
     pageInfo: PageInfo